@@ -0,0 +1,315 @@
+''' Offline benchmark of the bot's hot paths against a fake guild (see fake_discord.py), no Discord connection needed.
+
+Drives the real update_subcommunities, find_subcommunity, join_subcommunity and settings functions at configurable
+scales and reports tick latency, API call counts and memory use. Exits with code 1 if a regression threshold is
+exceeded, e.g.:
+
+    python3 benchmark.py --scale small --scale medium --max-tick-ms 200 --max-api-calls 5000
+    python3 benchmark.py --members 200000 --subcommunities 2000 --ticks 3
+    python3 benchmark.py --scale small --rate-limit-rate 0.05 --server-error-rate 0.02 --max-failed 0
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+import fake_discord
+
+SCALES = {
+    # name: (members, subcommunities)
+    "small": (1000, 10),
+    "medium": (10000, 100),
+    "large": (50000, 500),
+    "huge": (200000, 2000),
+}
+
+
+def setup_environment(extra_config, verbose=False):
+    ''' Point game_channels at a throwaway data directory with the given config and import it. '''
+    d = tempfile.mkdtemp(prefix='gc-bench-')
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    shutil.copy(os.path.join(script_dir, 'default_settings.json'), d)
+    config = {
+        "token": "",
+        "admin_id": 0,
+        "background_interval": 5,
+        "retry_backoff": 0.01,  # Simulated server errors shouldn't make the benchmark sleep for seconds
+        # Don't pace the fake API, we're measuring the bot's own overhead
+        "route_limits": {route: [1000000, 1] for route in (
+            "add_role", "remove_role", "create_role", "delete_role", "create_channel", "delete_channel",
+            "edit_channel", "edit_permissions", "send_message", "edit_message", "delete_message")},
+    }
+    config.update(extra_config)
+    with open(os.path.join(d, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    os.environ['GAME_CHANNELS_DIR'] = d
+    import game_channels
+    if not verbose:
+        game_channels.logger.setLevel(logging.WARNING)
+    return d, game_channels
+
+
+def game_names(n):
+    ''' Distinct made-up names of one to three words, for realistic variety in fuzzy matching. '''
+    rng = random.Random(n)
+    names = set()
+    while len(names) < n:
+        words = [''.join(rng.choice("bcdfghjklmnprstvwz") + rng.choice("aeiou") + rng.choice(["", "n", "r", "s", "x"])
+                         for _ in range(rng.randint(1, 3))) for _ in range(rng.randint(1, 3))]
+        names.add(' '.join(w.capitalize() for w in words))
+    return sorted(names)
+
+
+async def build_guild(gc, rng, members, subcommunities, args):
+    ''' Create a guild with members playing games, some of which already have a subcommunity. '''
+    guild = fake_discord.Guild(name="Benchmark {}x{}".format(members, subcommunities))
+    settings = gc.get_serv_settings(guild.id)
+    settings['enabled'] = True
+    settings['playerthreshold'] = args.threshold
+    if args.welcome:
+        settings['welcome'] = "Welcome #USER# to #GNAME#!"
+    await gc.initialize_server(guild)
+    wrapper = guild.get_channel(settings['wrapper_category'])
+
+    sc_games = game_names(subcommunities + args.new_games)
+    for gname in sc_games[:subcommunities]:
+        role = guild.add_role("Plays: " + gname)
+        channel = guild.add_text_channel(gc.convert_to_valid_channel_name(gname), category=wrapper)
+        settings['subcommunities'][gname] = {
+            "role_id": role.id,
+            "channel_id": channel.id,
+            "games": [gname, gname.upper().replace(" ", ": ", 1)],  # e.g. "Halo Reach" and "HALO: REACH"
+            "users_who_left": set(),
+        }
+    gc.set_serv_settings(guild.id, settings)
+
+    # Game popularity roughly follows a power law
+    weights = [1.0 / (i + 1) for i in range(len(sc_games))]
+    for i in range(members):
+        activity = None
+        if rng.random() < args.playing:
+            activity = fake_discord.Activity(rng.choices(sc_games, weights)[0])
+        m = guild.add_member(fake_discord.next_id(), "Member {}".format(i), activity)
+        if activity and activity.name in settings['subcommunities'] and rng.random() < args.joined:
+            m._roles.add(settings['subcommunities'][activity.name]['role_id'])
+    return guild, sc_games, weights
+
+
+async def drain(gc):
+    ''' Wait for queued API calls and pending games-list refreshes to finish. '''
+    while True:
+        tasks = [q.worker for q in gc.action_queues.values() if q.worker is not None and not q.worker.done()]
+        tasks += [t for t in gc.info_refresh_tasks.values() if not t.done()]
+        if not tasks:
+            return
+        await asyncio.gather(*tasks)
+
+
+async def churn(gc, guild, rng, sc_games, weights, fraction):
+    ''' Change the activity of a fraction of the members, firing member update events like the gateway would. '''
+    for m in rng.sample(guild.members, int(len(guild.members) * fraction)):
+        before = m.copy()
+        if m.activity is None or rng.random() < 0.5:
+            m.activity = fake_discord.Activity(rng.choices(sc_games, weights)[0])
+        else:
+            m.activity = None
+        await gc.on_member_update(before, m)
+
+
+async def run_scale(gc, name, members, subcommunities, args):
+    rng = random.Random(args.seed)
+    fake_discord.api_latency = 0.0
+    tracemalloc.start()  # Only while building the guild, it slows everything down a lot
+    guild, sc_games, weights = await build_guild(gc, rng, members, subcommunities, args)
+    await drain(gc)
+    setup_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    fake_discord.api_latency = args.api_latency
+    fake_discord.error_rates = {429: args.rate_limit_rate, 500: args.server_error_rate}
+    fake_discord.api_calls.clear()
+    fake_discord.api_errors.clear()
+    queue_before = queue_totals(gc)
+
+    result = {"scale": name, "members": members, "subcommunities": subcommunities, "ticks": []}
+    for tick in range(args.ticks + 1):
+        if tick > 0:
+            await churn(gc, guild, rng, sc_games, weights, args.churn)
+        calls_before = sum(fake_discord.api_calls.values())
+        t = time.perf_counter()
+        await gc.update_subcommunities(guild)
+        tick_time = time.perf_counter() - t
+        await drain(gc)
+        drain_time = time.perf_counter() - t - tick_time
+        result['ticks'].append({
+            "tick_ms": tick_time * 1000,
+            "drain_ms": drain_time * 1000,
+            "api_calls": sum(fake_discord.api_calls.values()) - calls_before,
+        })
+
+    # Keyword lookups: SC names, aliases, channel names and misses
+    settings = gc.get_serv_settings(guild.id)
+    keywords = []
+    for scn, sc in list(settings['subcommunities'].items())[:1000]:
+        keywords += [scn, sc['games'][-1], gc.convert_to_valid_channel_name(scn).replace(' ', '-'), scn + " 2"]
+    t = time.perf_counter()
+    for _ in range(max(1, 10000 // max(1, len(keywords)))):
+        for kw in keywords:
+            await gc.find_subcommunity(guild, kw)
+    lookups = max(1, 10000 // max(1, len(keywords))) * len(keywords)
+    result['find_us'] = (time.perf_counter() - t) / max(1, lookups) * 1e6
+
+    # Suggestions for misspelled names: a letter dropped from each SC name and alias
+    typos = [kw[:len(kw) // 2] + kw[len(kw) // 2 + 1:] for kw in keywords[::4] + keywords[1::4]]
+    t = time.perf_counter()
+    for kw in typos:
+        gc.fuzzy_find_subcommunities(guild, kw)
+    result['fuzzy_us'] = (time.perf_counter() - t) / max(1, len(typos)) * 1e6
+
+    # Manual joins
+    channel = guild.add_text_channel("bot-commands")
+    joiners = rng.sample(guild.members[1:], min(100, members))
+    t = time.perf_counter()
+    for m in joiners:
+        await gc.join_subcommunity(guild, rng.choice(list(settings['subcommunities'])), m, channel)
+    await drain(gc)
+    result['join_ms'] = (time.perf_counter() - t) / len(joiners) * 1000
+
+    # Repeated edits of the same message should be merged into one call while it waits in the queue
+    msg = channel.add_message("0", author=guild.me)
+    edits_before = fake_discord.api_calls['edit_message']
+    await asyncio.gather(*[gc.queue_action(guild, 'edit_message:' + str(channel.id), msg.edit, content=str(i),
+                                           key=('benchmark', msg.id)) for i in range(1, 51)])
+    result['merged_edits'] = {"submitted": 50, "api_calls": fake_discord.api_calls['edit_message'] - edits_before,
+                              "final": msg.content}
+
+    # Settings round trips
+    t = time.perf_counter()
+    for _ in range(1000):
+        gc.set_serv_settings(guild.id, gc.get_serv_settings(guild.id))
+    gc.flush_serv_settings()
+    result['settings_us'] = (time.perf_counter() - t) / 1000 * 1e6
+
+    result['setup_mb'] = setup_memory / 2 ** 20
+    result['peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    result['api_calls'] = dict(fake_discord.api_calls)
+    result['api_errors'] = {str(k): v for k, v in fake_discord.api_errors.items()}
+    result['queue'] = {k: v - queue_before[k] for k, v in queue_totals(gc).items()}
+    fake_discord.error_rates = {429: 0.0, 500: 0.0}
+    return result
+
+
+def queue_totals(gc):
+    totals = {"done": 0, "coalesced": 0, "retries": 0, "failed": 0}
+    for q in gc.action_queues.values():
+        for k in totals:
+            totals[k] += q.stats[k]
+    return totals
+
+
+def report(r):
+    first, rest = r['ticks'][0], r['ticks'][1:] or r['ticks']
+    print("== {scale}: {members} members, {subcommunities} subcommunities".format(**r))
+    print("  first tick (full scan): {:9.1f} ms  +{:8.1f} ms queued  {:6} API calls".format(
+        first['tick_ms'], first['drain_ms'], first['api_calls']))
+    print("  later ticks (avg):      {:9.1f} ms  +{:8.1f} ms queued  {:6.0f} API calls".format(
+        sum(t['tick_ms'] for t in rest) / len(rest), sum(t['drain_ms'] for t in rest) / len(rest),
+        sum(t['api_calls'] for t in rest) / len(rest)))
+    print("  find_subcommunity: {:.2f} us, fuzzy match: {:.1f} us, manual join: {:.2f} ms, settings get/set: {:.2f} us"
+          .format(r['find_us'], r['fuzzy_us'], r['join_ms'], r['settings_us']))
+    print("  memory: {:.1f} MB for the guild, {:.1f} MB peak RSS".format(r['setup_mb'], r['peak_mb']))
+    print("  API calls: " + ', '.join("{} {}".format(k, v) for k, v in sorted(r['api_calls'].items())))
+    print("  action queues: {done} done, {coalesced} merged, {retries} retries, {failed} failed".format(**r['queue']) +
+          ("  (simulated errors: {})".format(', '.join("{} x{}".format(k, v) for k, v in sorted(r['api_errors'].items())))
+           if r['api_errors'] else ""))
+    print("  {submitted} edits of one message: {api_calls} API call(s), final content {final!r}".format(
+        **r['merged_edits']))
+
+
+def check_thresholds(r, args):
+    failures = []
+    worst_tick = max(t['tick_ms'] for t in r['ticks'])
+    if args.max_tick_ms is not None and worst_tick > args.max_tick_ms:
+        failures.append("tick took {:.1f} ms (max {} ms)".format(worst_tick, args.max_tick_ms))
+    most_calls = max(t['api_calls'] for t in r['ticks'])
+    if args.max_api_calls is not None and most_calls > args.max_api_calls:
+        failures.append("tick made {} API calls (max {})".format(most_calls, args.max_api_calls))
+    if args.max_memory_mb is not None and r['peak_mb'] > args.max_memory_mb:
+        failures.append("peak memory {:.1f} MB (max {} MB)".format(r['peak_mb'], args.max_memory_mb))
+    if args.max_failed is not None and r['queue']['failed'] > args.max_failed:
+        failures.append("{} queued API calls failed (max {})".format(r['queue']['failed'], args.max_failed))
+    if r['merged_edits']['final'] != "50":
+        failures.append("merged edits ended with {!r} instead of the last edit".format(r['merged_edits']['final']))
+    if args.max_find_us is not None and r['find_us'] > args.max_find_us:
+        failures.append("find_subcommunity took {:.2f} us (max {} us)".format(r['find_us'], args.max_find_us))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', action='append', choices=sorted(SCALES),
+                        help="preset scale(s) to run (default: small and medium)")
+    parser.add_argument('--members', type=int, help="run a custom scale with this many members")
+    parser.add_argument('--subcommunities', type=int, default=100, help="subcommunities for a custom scale")
+    parser.add_argument('--new-games', type=int, default=20, help="games played that don't have a subcommunity yet")
+    parser.add_argument('--ticks', type=int, default=5, help="update ticks to run after the first full scan")
+    parser.add_argument('--playing', type=float, default=0.3, help="fraction of members playing a game")
+    parser.add_argument('--joined', type=float, default=0.8, help="fraction of players already in their game's role")
+    parser.add_argument('--churn', type=float, default=0.02, help="fraction of members changing game each tick")
+    parser.add_argument('--threshold', type=int, default=4, help="player threshold for new subcommunities")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds each fake API call takes")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help="fraction of fake API calls answered with 429 Too Many Requests")
+    parser.add_argument('--server-error-rate', type=float, default=0.0,
+                        help="fraction of fake API calls answered with 500 Internal Server Error")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--info-delay', type=float, default=0.01, help="info_message_delay to use")
+    parser.add_argument('--welcome', action='store_true', help="send welcome messages on join")
+    parser.add_argument('--welcome-digest', action='store_true', help="batch welcome messages")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="show the bot's log messages")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--max-tick-ms', type=float, help="fail if any update tick takes longer")
+    parser.add_argument('--max-api-calls', type=int, help="fail if any update tick makes more API calls")
+    parser.add_argument('--max-memory-mb', type=float, help="fail if peak RSS is higher")
+    parser.add_argument('--max-failed', type=int, help="fail if more queued API calls fail after retrying")
+    parser.add_argument('--max-find-us', type=float, help="fail if find_subcommunity is slower on average")
+    args = parser.parse_args()
+
+    scales = [(s, ) + SCALES[s] for s in (args.scale or ([] if args.members else ['small', 'medium']))]
+    if args.members:
+        scales.append(('custom', args.members, args.subcommunities))
+
+    data_dir, gc = setup_environment({
+        "settings_backend": args.backend,
+        "info_message_delay": args.info_delay,
+        "welcome_digest": args.welcome_digest,
+    }, args.verbose)
+    results = []
+    failed = False
+    try:
+        for name, members, subcommunities in scales:
+            r = asyncio.run(run_scale(gc, name, members, subcommunities, args))
+            report(r)
+            for failure in check_thresholds(r, args):
+                print("  FAILED: " + failure)
+                failed = True
+            results.append(r)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
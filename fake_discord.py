@@ -0,0 +1,373 @@
+''' In-memory stand-ins for the parts of discord.py that game_channels.py uses (guilds, members, roles, channels,
+    messages and activities), so the bot's code can be benchmarked and replayed without connecting to Discord.
+
+Every API call is counted in api_calls, and can be made to take api_latency seconds to simulate the network.
+'''
+import random
+import asyncio
+import collections
+import itertools
+from datetime import datetime
+from types import SimpleNamespace
+
+import discord
+
+api_calls = collections.Counter()
+api_latency = 0.0
+
+# Simulated failures: the fraction of calls that are rate limited (429) or hit a server error (500), and the API calls
+# that always fail with 403 Forbidden, e.g. {'add_roles'}
+error_rates = {429: 0.0, 500: 0.0}
+forbidden = set()
+retry_after = 0.01  # Sent in the Retry-After header of 429s
+api_errors = collections.Counter()
+_error_rng = random.Random(0)
+
+# The fake clock used for message timestamps and snowflake IDs, None means the real time
+current_time = None
+_sequence = itertools.count(1)
+
+
+def now():
+    return current_time if current_time is not None else datetime.utcnow()
+
+
+def set_time(t):
+    global current_time
+    current_time = t
+
+
+def next_id():
+    return discord.utils.time_snowflake(now()) + next(_sequence) % (1 << 22)
+
+
+def reset():
+    ''' Reset the API call counters and the ID sequence, for deterministic runs. '''
+    global _sequence, _error_rng
+    api_calls.clear()
+    api_errors.clear()
+    _sequence = itertools.count(1)
+    _error_rng = random.Random(0)
+
+
+async def api_call(name):
+    api_calls[name] += 1
+    await asyncio.sleep(api_latency)  # Even without latency, give other tasks a turn like a real request would
+    if name in forbidden:
+        api_errors[403] += 1
+        raise discord.errors.Forbidden(SimpleNamespace(status=403, reason="Forbidden", headers={}), "Missing Access")
+    for status, rate in sorted(error_rates.items()):
+        if rate and _error_rng.random() < rate:
+            api_errors[status] += 1
+            response = SimpleNamespace(status=status, reason="Simulated", headers={'Retry-After': str(retry_after)})
+            raise discord.errors.HTTPException(response, "Simulated error")
+
+
+def get_id(o):
+    if o is None or isinstance(o, int):
+        return o
+    if isinstance(o, datetime):
+        return discord.utils.time_snowflake(o)
+    return o.id
+
+
+class Activity:
+    def __init__(self, name, type=discord.ActivityType.playing):
+        self.name = name
+        self.type = type
+
+
+class Role:
+    def __init__(self, guild, name, id=None):
+        self.guild = guild
+        self.name = name
+        self.id = id or next_id()
+        self.created_at = discord.utils.snowflake_time(self.id)
+
+    def is_default(self):
+        return self.id == self.guild.id
+
+    @property
+    def mention(self):
+        return '<@&{}>'.format(self.id)
+
+    @property
+    def members(self):
+        # Like discord.py, this walks every member of the guild
+        if self.is_default():
+            return list(self.guild.members)
+        return [m for m in self.guild.members if self.id in m._roles]
+
+    async def delete(self):
+        await api_call('delete_role')
+        self.guild._remove_role(self)
+
+
+class Member:
+    def __init__(self, guild, id, name, activity=None, bot=False):
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.bot = bot
+        self.activity = activity
+        self._roles = set()
+
+    @property
+    def activities(self):
+        return (self.activity,) if self.activity else ()
+
+    @property
+    def display_name(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return '<@{}>'.format(self.id)
+
+    @property
+    def roles(self):
+        return [self.guild.default_role] + [self.guild._roles[i] for i in self._roles if i in self.guild._roles]
+
+    def avatar_url_as(self, size=1024):
+        return 'https://cdn.discordapp.com/embed/avatars/{}.png?size={}'.format(self.id % 5, size)
+
+    def copy(self):
+        ''' Shallow copy to use as the "before" member of an update event. '''
+        m = Member(self.guild, self.id, self.name, self.activity, self.bot)
+        m._roles = set(self._roles)
+        return m
+
+    async def add_roles(self, *roles):
+        await api_call('add_roles')
+        self._roles.update(r.id for r in roles)
+
+    async def remove_roles(self, *roles):
+        await api_call('remove_roles')
+        self._roles.difference_update(r.id for r in roles)
+
+
+class Message:
+    def __init__(self, channel, content=None, embed=None, author=None, id=None):
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content or ""
+        self.embed = embed
+        self.author = author
+        self.id = id or next_id()
+        self.created_at = discord.utils.snowflake_time(self.id)
+
+    @property
+    def jump_url(self):
+        return 'https://discord.com/channels/{}/{}/{}'.format(self.guild.id, self.channel.id, self.id)
+
+    async def edit(self, content=None, embed=None):
+        await api_call('edit_message')
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+
+    async def delete(self):
+        await api_call('delete_message')
+        self.channel.messages.pop(self.id, None)
+
+    async def add_reaction(self, emoji):
+        await api_call('add_reaction')
+
+
+class CategoryChannel:
+    def __init__(self, guild, name, id=None, position=0):
+        self.guild = guild
+        self.name = name
+        self.id = id or next_id()
+        self.position = position
+        self.category = None
+
+    @property
+    def channels(self):
+        return sorted((c for c in self.guild.text_channels if c.category is self), key=lambda c: c.position)
+
+    async def delete(self):
+        await api_call('delete_channel')
+        self.guild._remove_channel(self)
+
+
+class TextChannel:
+    def __init__(self, guild, name, category=None, id=None, position=0):
+        self.guild = guild
+        self.name = name.lower().replace(' ', '-')
+        self.category = category
+        self.id = id or next_id()
+        self.position = position
+        self.created_at = discord.utils.snowflake_time(self.id)
+        self.messages = collections.OrderedDict()  # {message_id: Message}, oldest first
+        self.last_message_id = None
+        self.permissions = {}
+
+    @property
+    def mention(self):
+        return '<#{}>'.format(self.id)
+
+    @property
+    def category_id(self):
+        return self.category.id if self.category is not None else None
+
+    def add_message(self, content=None, embed=None, author=None, id=None):
+        ''' Add a message without counting an API call, e.g. one sent by a user. '''
+        m = Message(self, content, embed, author, id)
+        self.messages[m.id] = m
+        self.last_message_id = m.id
+        return m
+
+    async def send(self, content=None, embed=None):
+        await api_call('send_message')
+        return self.add_message(content, embed, self.guild.me)
+
+    async def fetch_message(self, id):
+        await api_call('fetch_message')
+        if id not in self.messages:
+            raise discord.errors.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+        return self.messages[id]
+
+    async def set_permissions(self, target, **permissions):
+        await api_call('edit_permissions')
+        self.permissions[target.id] = permissions
+
+    async def edit(self, **fields):
+        await api_call('edit_channel')
+        for k, v in fields.items():
+            setattr(self, k, v)
+
+    async def delete(self):
+        await api_call('delete_channel')
+        self.guild._remove_channel(self)
+
+    async def delete_messages(self, messages):
+        await api_call('bulk_delete_messages')
+        for m in messages:
+            self.messages.pop(m.id, None)
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        before = get_id(before)
+        after = get_id(after)
+        messages = [m for m in self.messages.values()
+                    if (before is None or m.id < before) and (after is None or m.id > after)]
+        if not (oldest_first or (oldest_first is None and after is not None)):
+            messages.reverse()
+        for i, m in enumerate(messages[:limit] if limit else messages):
+            if i % 100 == 0:
+                await api_call('history')  # One request per 100 messages
+            yield m
+
+
+class FakeHTTP:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def bulk_channel_update(self, guild_id, data, *, reason=None):
+        await api_call('bulk_channel_update')
+        for d in data:
+            ch = self.guild.get_channel(int(d['id']))
+            if ch is not None:
+                ch.position = d['position']
+
+
+class Guild:
+    def __init__(self, id=None, name="Benchmark Guild"):
+        self.id = id or next_id()
+        self.name = name
+        self.region = "fake"
+        self.members = []
+        self._members = {}
+        self.roles = []
+        self._roles = {}
+        self._channels = {}
+        self.default_role = self._add_role(Role(self, "@everyone", id=self.id))
+        self.me = self.add_member(next_id(), "Game Channels", bot=True)
+        self._state = SimpleNamespace(http=FakeHTTP(self))
+
+    # Setting up the guild, these aren't counted as API calls
+
+    def add_member(self, id, name, activity=None, bot=False):
+        m = Member(self, id, name, activity, bot)
+        self.members.append(m)
+        self._members[id] = m
+        return m
+
+    def remove_member(self, member):
+        self.members.remove(member)
+        del self._members[member.id]
+
+    def _add_role(self, role):
+        self.roles.append(role)
+        self._roles[role.id] = role
+        return role
+
+    def _remove_role(self, role):
+        self.roles.remove(role)
+        del self._roles[role.id]
+        for m in self.members:
+            m._roles.discard(role.id)
+
+    def add_role(self, name, id=None):
+        return self._add_role(Role(self, name, id))
+
+    def add_text_channel(self, name, category=None, id=None):
+        ch = TextChannel(self, name, category, id, position=len(self._channels))
+        self._channels[ch.id] = ch
+        return ch
+
+    def add_category(self, name, id=None):
+        cat = CategoryChannel(self, name, id, position=len(self._channels))
+        self._channels[cat.id] = cat
+        return cat
+
+    def _remove_channel(self, channel):
+        self._channels.pop(channel.id, None)
+
+    # discord.Guild interface
+
+    @property
+    def member_count(self):
+        return len(self.members)
+
+    @property
+    def chunked(self):
+        return True
+
+    @property
+    def channels(self):
+        return list(self._channels.values())
+
+    @property
+    def text_channels(self):
+        return [c for c in self._channels.values() if isinstance(c, TextChannel)]
+
+    @property
+    def categories(self):
+        return [c for c in self._channels.values() if isinstance(c, CategoryChannel)]
+
+    def get_member(self, id):
+        return self._members.get(id)
+
+    def get_role(self, id):
+        return self._roles.get(id)
+
+    def get_channel(self, id):
+        return self._channels.get(id)
+
+    async def create_role(self, name="new role", **fields):
+        await api_call('create_role')
+        return self.add_role(name)
+
+    async def create_text_channel(self, name, category=None, **fields):
+        await api_call('create_channel')
+        return self.add_text_channel(name, category)
+
+    async def create_category(self, name, **fields):
+        await api_call('create_channel')
+        return self.add_category(name)
+
+    async def chunk(self, cache=True):
+        await api_call('chunk')
+        return self.members
@@ -1,23 +1,37 @@
 import os
 import json
+import time
+import atexit
+import asyncio
+import gzip
+import sqlite3
+import subprocess
+import collections
+import heapq
+import itertools
+import functools
+import fnmatch
+import re
 import discord
 import logging
+import logging.handlers
+import queue
+import threading
 import sys
 from datetime import datetime, timedelta
 from discord.ext.tasks import loop
 
 ''' TODO
-Prune channels older than 8 months that haven't had *any* activity ever.
-If less than 10 players, just delete it.
-If more than 10 players, send message "This channel will be deleted if it still has no activity in the next week".
-Maybe keep roles around in case the game gets popular again?
+Maybe keep roles around when pruning inactive channels, in case the game gets popular again?
 '''
 
 logging.basicConfig(level=logging.INFO)
 ADMIN = None
+start_time = time.time()
 
 last_channel = None
-script_dir = os.path.dirname(os.path.realpath(__file__))
+# GAME_CHANNELS_DIR lets tools like benchmark.py run the bot's code against a separate config and guild data
+script_dir = os.environ.get('GAME_CHANNELS_DIR') or os.path.dirname(os.path.realpath(__file__))
 script_dir = script_dir + ('/' if not script_dir.endswith('/') else '')
 
 default_sc_dict = {
@@ -39,7 +53,7 @@ def write_json(fp, data):
     if not os.path.exists(d):
         os.makedirs(d)
     with open(fp, 'w') as f:
-        f.write(json.dumps(data, indent=4, sort_keys=True))
+        f.write(json.dumps(data, indent=4, sort_keys=True, default=sorted))  # Sets are saved as sorted lists
 
 
 def get_config():
@@ -54,19 +68,292 @@ def get_config():
 
 config = get_config()
 
+# Set for the child processes started by run_shard_processes, each of which runs a group of shards
+shard_ids = [int(i) for i in os.environ['GC_SHARD_IDS'].split(',')] if os.environ.get('GC_SHARD_IDS') else None
+shard_count = int(os.environ.get('GC_SHARD_COUNT', 0)) or config.get('shard_count')
+shard_key = '-'.join(str(i) for i in shard_ids) if shard_ids is not None else 'all'
+sharded = bool(config.get('sharded') or shard_count)
+
+
+class StageStats:
+    ''' Call count and rolling timings (the last 'metrics_window' calls) of one instrumented stage. '''
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.samples = collections.deque(maxlen=config.get('metrics_window', 1000))
+
+    def add(self, seconds, error=False):
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+        if error:
+            self.errors += 1
+
+    def percentiles(self, *ps):
+        samples = sorted(self.samples)
+        if not samples:
+            return [0.0 for p in ps]
+        return [samples[min(len(samples) - 1, int(p * len(samples)))] for p in ps]
+
+
+stage_stats = {}  # {stage name: StageStats}
+
+
+class timed:
+    ''' Context manager that records how long the block took under the given stage name. '''
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.stage not in stage_stats:
+            stage_stats[self.stage] = StageStats()
+        stage_stats[self.stage].add(time.perf_counter() - self.start, error=exc_type is not None)
+
+
+def instrumented(stage):
+    ''' Decorator for coroutines that records their timing under the given stage name. '''
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timed(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class JsonSettingsStore:
+    ''' Stores each guild's settings as guilds/<id>.json '''
+
+    def path(self, serv_id):
+        return os.path.join(script_dir, 'guilds', str(serv_id) + '.json')
+
+    def load(self, serv_id):
+        fp = self.path(serv_id)
+        if not os.path.exists(fp):
+            return None
+        return read_json(fp)
+
+    def save(self, serv_id, settings):
+        write_json(self.path(serv_id), settings)
+
+    def save_shard_status(self, key, status):
+        write_json(os.path.join(script_dir, 'shards', key + '.json'), status)
+
+    def load_shard_statuses(self):
+        d = os.path.join(script_dir, 'shards')
+        if not os.path.exists(d):
+            return {}
+        return {fn[:-len('.json')]: read_json(os.path.join(d, fn)) for fn in sorted(os.listdir(d))
+                if fn.endswith('.json')}
+
+
+class SqliteSettingsStore:
+    ''' Stores guild settings in an SQLite database, with subcommunities, their game aliases and the users who left
+        them in their own indexed tables. Saving only writes the rows that changed since the last load/save. '''
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            settings TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS subcommunities (
+            guild_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            role_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            extra TEXT NOT NULL DEFAULT '{}',
+            PRIMARY KEY (guild_id, name)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS subcommunities_channel ON subcommunities (guild_id, channel_id);
+        CREATE TABLE IF NOT EXISTS aliases (
+            guild_id INTEGER NOT NULL,
+            sc_name TEXT NOT NULL,
+            alias TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, sc_name, alias)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS aliases_alias ON aliases (guild_id, alias COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS users_who_left (
+            guild_id INTEGER NOT NULL,
+            sc_name TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, sc_name, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS users_who_left_user ON users_who_left (guild_id, user_id);
+        CREATE TABLE IF NOT EXISTS shard_status (
+            shard_key TEXT PRIMARY KEY,
+            status TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, fp):
+        self.db = sqlite3.connect(fp, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")  # Shard processes may share the database
+        self.db.executescript(self.schema)
+        self.saved = {}  # {guild_id: flattened settings as last loaded/saved}, to work out which rows changed
+
+    @staticmethod
+    def flatten(settings):
+        scalars = {k: v for k, v in settings.items() if k != 'subcommunities'}
+        scs = {}
+        for scn, sc in settings.get('subcommunities', {}).items():
+            extra = {k: v for k, v in sc.items() if k not in default_sc_dict}
+            scs[scn] = (sc['role_id'], sc['channel_id'], tuple(sc['games']), frozenset(sc['users_who_left']),
+                        json.dumps(extra, sort_keys=True))
+        return json.dumps(scalars, sort_keys=True), scs
+
+    def load(self, serv_id):
+        row = self.db.execute("SELECT settings FROM guilds WHERE guild_id = ?", (serv_id,)).fetchone()
+        if row is None:
+            return None
+        settings = json.loads(row[0])
+        scs = {}
+        for name, role_id, channel_id, extra in self.db.execute(
+                "SELECT name, role_id, channel_id, extra FROM subcommunities WHERE guild_id = ?", (serv_id,)):
+            sc = json.loads(extra)
+            sc.update({"role_id": role_id, "channel_id": channel_id, "games": [], "users_who_left": []})
+            scs[name] = sc
+        for sc_name, alias in self.db.execute(
+                "SELECT sc_name, alias FROM aliases WHERE guild_id = ? ORDER BY position", (serv_id,)):
+            scs[sc_name]['games'].append(alias)
+        for sc_name, user_id in self.db.execute(
+                "SELECT sc_name, user_id FROM users_who_left WHERE guild_id = ?", (serv_id,)):
+            scs[sc_name]['users_who_left'].append(user_id)
+        settings['subcommunities'] = scs
+        self.saved[serv_id] = self.flatten(settings)
+        return settings
+
+    def save(self, serv_id, settings):
+        old_scalars, old_scs = self.saved.get(serv_id, (None, {}))
+        scalars, scs = self.flatten(settings)
+        with self.db:  # One transaction per guild
+            if scalars != old_scalars:
+                self.db.execute("INSERT OR REPLACE INTO guilds (guild_id, settings) VALUES (?, ?)",
+                                (serv_id, scalars))
+            for scn in old_scs.keys() - scs.keys():
+                for table, column in (('subcommunities', 'name'), ('aliases', 'sc_name'),
+                                      ('users_who_left', 'sc_name')):
+                    self.db.execute("DELETE FROM {} WHERE guild_id = ? AND {} = ?".format(table, column),
+                                    (serv_id, scn))
+            for scn, new in scs.items():
+                old = old_scs.get(scn, (None, None, (), frozenset(), None))
+                if new == old:
+                    continue
+                role_id, channel_id, games, users_who_left, extra = new
+                if (role_id, channel_id, extra) != (old[0], old[1], old[4]):
+                    self.db.execute("INSERT OR REPLACE INTO subcommunities (guild_id, name, role_id, channel_id, "
+                                    "extra) VALUES (?, ?, ?, ?, ?)", (serv_id, scn, role_id, channel_id, extra))
+                if games != old[2]:
+                    self.db.execute("DELETE FROM aliases WHERE guild_id = ? AND sc_name = ?", (serv_id, scn))
+                    self.db.executemany("INSERT OR IGNORE INTO aliases (guild_id, sc_name, alias, position) "
+                                        "VALUES (?, ?, ?, ?)", [(serv_id, scn, g, i) for i, g in enumerate(games)])
+                self.db.executemany("DELETE FROM users_who_left WHERE guild_id = ? AND sc_name = ? AND user_id = ?",
+                                    [(serv_id, scn, u) for u in old[3] - users_who_left])
+                self.db.executemany("INSERT OR IGNORE INTO users_who_left (guild_id, sc_name, user_id) "
+                                    "VALUES (?, ?, ?)", [(serv_id, scn, u) for u in users_who_left - old[3]])
+        self.saved[serv_id] = (scalars, scs)
+
+    def save_shard_status(self, key, status):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO shard_status (shard_key, status) VALUES (?, ?)",
+                            (key, json.dumps(status)))
+
+    def load_shard_statuses(self):
+        return {k: json.loads(v) for k, v in self.db.execute(
+            "SELECT shard_key, status FROM shard_status ORDER BY shard_key")}
+
+    def import_json(self, directory):
+        ''' One-shot import of guilds/*.json, skipping guilds that are already in the database. '''
+        imported = 0
+        for fn in sorted(os.listdir(directory)):
+            if not fn.endswith('.json'):
+                continue
+            try:
+                serv_id = int(fn[:-len('.json')])
+            except ValueError:
+                continue
+            if self.load(serv_id) is not None:
+                continue
+            self.save(serv_id, read_json(os.path.join(directory, fn)))
+            imported += 1
+        return imported
+
+
+def get_settings_store():
+    if config.get('settings_backend', 'json') == 'sqlite':
+        return SqliteSettingsStore(os.path.join(script_dir, config.get('sqlite_path', 'guilds.db')))
+    return JsonSettingsStore()
+
+
+settings_store = get_settings_store()
+
+# In-memory settings store. Settings are read from disk once per guild, edits only mark the guild as dirty and
+# are written back by flush_serv_settings (on a timer and at shutdown).
+settings_cache = {}
+settings_dirty = set()
+guild_enabled = {}  # {guild_id: bool}, so the update scheduler can skip disabled guilds without reading their settings
+settings_stats = {
+    "hits": 0,
+    "disk_reads": 0,
+    "disk_writes": 0,
+}
+
 
 def get_serv_settings(serv_id):
-    global script_dir
-    fp = os.path.join(script_dir, 'guilds', str(serv_id) + '.json')
-    if not os.path.exists(fp):
-        write_json(fp, read_json(os.path.join(script_dir, 'default_settings.json')))
-    return read_json(fp)
+    if serv_id in settings_cache:
+        settings_stats['hits'] += 1
+        return settings_cache[serv_id]
+
+    with timed('settings_load'):
+        settings = settings_store.load(serv_id)
+    settings_stats['disk_reads'] += 1
+    if settings is None:
+        settings = read_json(os.path.join(script_dir, 'default_settings.json'))
+        with timed('settings_save'):
+            settings_store.save(serv_id, settings)
+        settings_stats['disk_writes'] += 1
+    settings_cache[serv_id] = load_opt_out_sets(settings)
+    guild_enabled[serv_id] = settings['enabled']
+    return settings
+
+
+def load_opt_out_sets(settings):
+    ''' The users who left each subcommunity are kept as a set in memory, so auto-joining can skip them in O(1). '''
+    for sc in settings['subcommunities'].values():
+        sc['users_who_left'] = set(sc['users_who_left'])
+    return settings
 
 
 def set_serv_settings(serv_id, settings):
-    global script_dir
-    fp = os.path.join(script_dir, 'guilds', str(serv_id) + '.json')
-    return write_json(fp, settings)
+    settings_cache[serv_id] = settings
+    settings_dirty.add(serv_id)
+    if settings['enabled'] and guild_enabled.get(serv_id) is False and serv_id in scan_state:
+        # Disabled guilds are only looked at every scan_max_interval, scan a re-enabled one on the next tick instead
+        scan_state[serv_id]['next'] = time.monotonic()
+        heapq.heappush(scan_queue, (scan_state[serv_id]['next'], serv_id))
+    guild_enabled[serv_id] = settings['enabled']
+
+
+def flush_serv_settings():
+    ''' Write all dirty guild settings to disk. Returns the number of guilds written. '''
+    written = 0
+    for serv_id in list(settings_dirty):
+        settings_dirty.discard(serv_id)
+        with timed('settings_save'):
+            settings_store.save(serv_id, settings_cache[serv_id])
+        settings_stats['disk_writes'] += 1
+        written += 1
+    return written
+
+
+atexit.register(flush_serv_settings)
 
 
 def ldir(o):
@@ -95,15 +382,20 @@ def strip_quotes(s):
     return s
 
 
+class AsciiTable(dict):
+    ''' str.translate table that keeps printable ASCII and replaces every other character with "_" '''
+
+    def __missing__(self, c):
+        return '_'
+
+
+ASCII_TABLE = AsciiTable({i: i for i in range(32, 127)})
+
+
 def ascii_only(s):
-    ns = ""
-    printable_chars = list([chr(i) for i in range(32, 127)])
-    for c in s:
-        if c in printable_chars:
-            ns += c
-        else:
-            ns += '_'
-    return ns
+    if s.isascii() and s.isprintable():
+        return s
+    return s.translate(ASCII_TABLE)
 
 
 def convert_to_valid_channel_name(s):
@@ -117,32 +409,273 @@ def convert_to_valid_channel_name(s):
     return sn
 
 
-def log(msg, guild=None):
-    text = datetime.now().strftime("%Y-%m-%d %H:%M")
-    text += ' '
-    if guild:
-        text += '[' + guild.name + ']'
+def log(msg, guild=None, exc_info=None, **fields):
+    ''' Log a message, optionally with structured fields (e.g. user, action, latency) and a traceback (exc_info=True
+        inside an except block, or the exception itself). Formatting and writing happens on the logging thread, so
+        this never blocks the event loop. '''
+    logger.info(msg, exc_info=exc_info, extra={'guild': guild.name if guild else None, 'fields': fields})
+
+
+# Every byte except UTF-8 continuation bytes (0b10xxxxxx), deleting these from a block leaves only continuation bytes
+NON_CONTINUATION_BYTES = bytes(b for b in range(256) if b & 0xC0 != 0x80)
+
+
+def read_log_tail(fp, num_chars, block_size=8192):
+    ''' Return the last num_chars characters of a UTF-8 file, reading backwards from the end in blocks
+        instead of reading the whole file. '''
+    blocks = []
+    chars = 0
+    with open(fp, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0 and chars < num_chars:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size)
+            blocks.append(block)
+            chars += len(block) - len(block.translate(None, NON_CONTINUATION_BYTES))
+    data = b''.join(reversed(blocks))
+    # The first block may start in the middle of a multi-byte character, skip to the start of the next one
+    start = 0
+    while pos > 0 and start < len(data) and data[start] & 0xC0 == 0x80:
+        start += 1
+    return data[start:].decode('utf8', errors='replace')[-num_chars:]
+
+
+class RotatingLogFile:
+    ''' File-like object that appends to a log file, and rotates it (log.txt -> log.txt.1 -> ...) once it grows
+        past max_bytes so it never grows without bound. '''
+
+    def __init__(self, fp, max_bytes, backups):
+        self.fp = fp
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        self.f = open(fp, 'a', encoding="utf8")
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.fp, i)):
+                os.replace("{}.{}".format(self.fp, i), "{}.{}".format(self.fp, i + 1))
+        if self.backups > 0:
+            os.replace(self.fp, self.fp + ".1")
+        else:
+            os.remove(self.fp)
+        self.f = open(self.fp, 'a', encoding="utf8")
+
+    def write(self, text):
+        with self.lock:  # Written to from both the logging thread and the event loop
+            n = self.f.write(text)
+            if self.max_bytes and self.f.tell() >= self.max_bytes:
+                self.rotate()
+        return n
+
+    def flush(self):
+        with self.lock:
+            self.f.flush()
+
+
+if config.get('log_file'):
+    # Send everything that's printed (log messages, tracebacks and discord.py's logging) to the log file
+    log_fp = os.path.join(script_dir, config['log_file'])
+    if shard_ids is not None:
+        # Each shard process gets its own log file, e.g. log-shards-0-2.txt
+        log_fp = "{0}-shards-{2}{1}".format(*os.path.splitext(log_fp), shard_key)
+    sys.stdout = sys.stderr = RotatingLogFile(log_fp,
+                                              config.get('log_max_bytes', 10 * 1024 * 1024),
+                                              config.get('log_backups', 3))
+    logging.getLogger().handlers[0].setStream(sys.stderr)
+
+
+class LogFormatter(logging.Formatter):
+    def format(self, record):
+        text = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M")
         text += ' '
-    text += str(ascii_only(msg))
-    print(text)
+        if record.guild:
+            text += '[' + record.guild + ']'
+            text += ' '
+        text += ascii_only(str(record.msg))
+        for k, v in record.fields.items():
+            text += ' {}={}'.format(k, ascii_only(str(v)))
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)  # Keep the traceback's lines as they are
+        return text
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record  # Leave formatting to the logging thread
+
+
+# log() only puts records on a queue, a background thread formats and writes them
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(LogFormatter())
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+logger = logging.getLogger('game_channels')
+logger.propagate = False
+logger.addHandler(LogQueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 
 
 async def catch_http_error(function, *args, **kwargs):
     try:
-        if args or kwargs:
-            if args and not kwargs:
-                r = await function(*args)
-            elif kwargs and not args:
-                r = await function(**kwargs)
+        with timed('api:' + function.__name__):
+            if args or kwargs:
+                if args and not kwargs:
+                    r = await function(*args)
+                elif kwargs and not args:
+                    r = await function(**kwargs)
+                else:
+                    r = await function(*args, **kwargs)
             else:
-                r = await function(*args, **kwargs)
-        else:
-            r = await function()
+                r = await function()
         return r
     except discord.errors.HTTPException:
-        import traceback
-        print(traceback.format_exc())
-        log("   !! ENCOUNTERED HTTP ERROR IN FUNC " + function.__name__ + " !!")
+        log("   !! ENCOUNTERED HTTP ERROR IN FUNC " + function.__name__ + " !!",
+            action=function.__name__, exc_info=True)
+
+
+# Default (calls, seconds) limits for each route, roughly matching Discord's per-route rate limit buckets.
+# Routes are named "<route>" or "<route>:<major id>", e.g. "send_message:<channel id>". Override with 'route_limits'.
+default_route_limits = {
+    "add_role": (10, 10.0),
+    "remove_role": (10, 10.0),
+    "create_role": (5, 10.0),
+    "delete_role": (5, 10.0),
+    "create_channel": (5, 10.0),
+    "delete_channel": (5, 10.0),
+    "edit_channel": (5, 10.0),
+    "edit_permissions": (5, 5.0),
+    "send_message": (5, 5.0),
+    "edit_message": (5, 5.0),
+    "delete_message": (5, 5.0),
+}
+route_limits = dict(default_route_limits)
+route_limits.update({k: tuple(v) for k, v in config.get('route_limits', {}).items()})
+
+
+class ActionQueue:
+    ''' Per-guild queue of Discord API calls.
+
+    Calls are made one at a time, paced against the route's bucket, and retried with backoff when rate limited or
+    when Discord has a server error. Calls submitted with a key that is already waiting in the queue are merged into
+    the waiting one, using the newest arguments (so repeated edits of the same message only send the last one).
+    '''
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = collections.deque()
+        self.pending = {}  # key -> queued action
+        self.buckets = {}  # route -> deque of call times
+        self.worker = None
+        self.stats = {
+            "done": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "failed": 0,
+        }
+
+    def depth(self):
+        return len(self.queue)
+
+    def submit(self, route, func, *args, key=None, **kwargs):
+        if key is not None and key in self.pending:
+            action = self.pending[key]
+            action['func'] = func
+            action['args'] = args
+            action['kwargs'] = kwargs
+            self.stats['coalesced'] += 1
+            return action['future']
+
+        action = {
+            "route": route,
+            "func": func,
+            "args": args,
+            "kwargs": kwargs,
+            "key": key,
+            "future": asyncio.get_event_loop().create_future(),
+        }
+        self.queue.append(action)
+        if key is not None:
+            self.pending[key] = action
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self.run())
+        return action['future']
+
+    async def wait_for_bucket(self, route):
+        limit, per = route_limits.get(route.split(':', 1)[0], (5, 5.0))
+        calls = self.buckets.setdefault(route, collections.deque())
+        now = time.monotonic()
+        while calls and calls[0] <= now - per:
+            calls.popleft()
+        if len(calls) >= limit:
+            await asyncio.sleep(calls[0] + per - now)
+            calls.popleft()
+        calls.append(time.monotonic())
+
+    async def call(self, action):
+        max_retries = config.get('max_retries', 3)
+        for attempt in range(max_retries + 1):
+            try:
+                with timed('api:' + action['route'].split(':', 1)[0]):
+                    return await action['func'](*action['args'], **action['kwargs'])
+            except discord.errors.HTTPException as e:
+                if (e.status == 429 or e.status >= 500) and attempt < max_retries:
+                    self.stats['retries'] += 1
+                    await asyncio.sleep(get_retry_after(e) or config.get('retry_backoff', 1.0) * 2 ** attempt)
+                    continue
+                self.stats['failed'] += 1
+                log("   !! ENCOUNTERED HTTP ERROR IN ACTION " + action['route'] + " !!",
+                    action=action['route'], guild_id=self.guild_id, exc_info=True)
+                return None
+
+    async def run(self):
+        while self.queue:
+            action = self.queue.popleft()
+            if action['key'] is not None:
+                self.pending.pop(action['key'], None)
+            await self.wait_for_bucket(action['route'])
+            try:
+                result = await self.call(action)
+            except Exception as e:
+                self.stats['failed'] += 1
+                if not action['future'].done():
+                    action['future'].set_exception(e)
+                continue
+            self.stats['done'] += 1
+            if not action['future'].done():
+                action['future'].set_result(result)
+
+
+action_queues = {}  # {guild_id: ActionQueue}
+
+
+def get_retry_after(e):
+    try:
+        return float(e.response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def queue_action(guild, route, func, *args, key=None, **kwargs):
+    ''' Schedule a Discord API call on the guild's action queue, returns a future with the call's result. '''
+    if guild.id not in action_queues:
+        action_queues[guild.id] = ActionQueue(guild.id)
+    return action_queues[guild.id].submit(route, func, *args, key=key, **kwargs)
+
+
+async def grant_role(member, role):
+    ''' add_roles returns None, this returns True so callers can tell a grant from a call that failed. '''
+    await member.add_roles(role)
+    return True
+
+
+async def revoke_role(member, role):
+    await member.remove_roles(role)
+    return True
 
 
 async def get_admin_channel(guild):
@@ -153,15 +686,17 @@ async def get_admin_channel(guild):
     return None
 
 
-async def update_info_message(guild):
-    settings = get_serv_settings(guild.id)
-    ch = guild.get_channel(settings['instructions_channel'])
-    msg = await ch.fetch_message(settings['instructions_message'])
+info_messages = {}  # {guild_id: discord.Message}, saves fetching the games-list message for every edit
+info_message_text = {}  # {guild_id: text}, the games list as it was last sent
+info_refresh_tasks = {}  # {guild_id: asyncio.Task}, refreshes waiting for the debounce window to pass
+
+
+def render_info_message(guild, settings):
     scs = sorted(settings["subcommunities"], key=lambda s: s.lower())
     text = "This server has dedicated channels for the following {} games:\n\n".format(len(scs))
     for sc in scs:
         role = guild.get_role(settings["subcommunities"][sc]['role_id'])
-        num = len(role.members) if role is not None else 0
+        num = len(get_role_members(guild, role)) if role is not None else 0
         text += "• **" + sc + "**"
         text += "  (" + str(num) + ")"
         text += "\n"
@@ -172,28 +707,259 @@ async def update_info_message(guild):
     text += str(settings["playerthreshold"])
     text += " or more people in this server play that game.\n"
     text += "Messages in this channel will automatically be deleted after a while."
+    return text
+
+
+async def get_info_message(guild):
+    settings = get_serv_settings(guild.id)
+    msg = info_messages.get(guild.id)
+    if msg is None or msg.id != settings['instructions_message']:
+        ch = guild.get_channel(settings['instructions_channel'])
+        if ch is None:
+            return None
+        msg = await catch_http_error(ch.fetch_message, settings['instructions_message'])
+        if msg is None:
+            return None
+        info_messages[guild.id] = msg
+    return msg
+
+
+async def edit_info_message(msg, text):
     await msg.edit(content=text)
+    return True
 
 
-async def find_subcommunity(guild, keyword):
-    ''' Return a tuple of (name, subcommunity) from a given keyword by matching SC name, game name and channel name. '''
+@instrumented('update_info_message')
+async def refresh_info_message(guild, force=False):
+    settings = get_serv_settings(guild.id)
+    text = render_info_message(guild, settings)
+    if not force and info_message_text.get(guild.id) == text:
+        return  # Nothing visible changed
+    msg = await get_info_message(guild)
+    if msg is None:
+        return
+    if await queue_action(guild, 'edit_message:' + str(msg.channel.id), edit_info_message, msg, text,
+                          key=('info_message', msg.id)):
+        info_message_text[guild.id] = text
+
+
+async def delayed_info_message_refresh(guild, delay):
+    await asyncio.sleep(delay)
+    del info_refresh_tasks[guild.id]  # Changes made while refreshing need to schedule another refresh
+    await refresh_info_message(guild)
+
+
+async def update_info_message(guild, force=False):
+    ''' Refresh the games list. Refreshes requested within 'info_message_delay' seconds of each other are merged,
+        and the message is only edited if its text actually changed. Use force to edit it right away. '''
+    delay = config.get('info_message_delay', 5)
+    if force or not delay:
+        await refresh_info_message(guild, force=force)
+        return
+    if guild.id not in info_refresh_tasks:
+        info_refresh_tasks[guild.id] = asyncio.ensure_future(delayed_info_message_refresh(guild, delay))
+
+
+# Per-guild lookup index used by find_subcommunity, mapping casefolded SC names, casefolded game aliases and
+# channel names to the SC name: {guild_id: {'names': {}, 'games': {}, 'channels': {}, 'terms': {}, 'grams': {}}}
+# 'terms' and 'grams' are for fuzzy matching: {term: (SC name, set(trigram))} and {trigram: set(term)}
+sc_index = {}
+
+
+def trigrams(s):
+    s = ' '.join(''.join(c if c.isalnum() else ' ' for c in s.casefold()).split())
+    s = '  ' + s + ' '  # Padded so the start of the name counts for more, like "  r" and " ro" in "rocket"
+    return set(s[i:i + 3] for i in range(len(s) - 2))
 
+
+def channel_name_key(s):
+    # Discord turns spaces into dashes in text channel names
+    return convert_to_valid_channel_name(s).replace(' ', '-')
+
+
+def _index_add(index, guild, scn, sc):
+    index['names'][scn.casefold()] = scn
+    for g in sc['games']:
+        index['games'].setdefault(g.casefold(), scn)
+    ch = guild.get_channel(sc['channel_id'])
+    if ch is not None:
+        index['channels'].setdefault(ch.name, scn)
+    for term in [scn] + sc['games']:
+        term = term.casefold()
+        if term not in index['terms']:
+            grams = trigrams(term)
+            index['terms'][term] = (scn, grams)
+            for g in grams:
+                index['grams'].setdefault(g, set()).add(term)
+
+
+def _index_remove(index, scn):
+    for kind in ('names', 'games', 'channels'):
+        for k in [k for k, v in index[kind].items() if v == scn]:
+            del index[kind][k]
+    for term in [t for t, (v, _) in index['terms'].items() if v == scn]:
+        for g in index['terms'].pop(term)[1]:
+            index['grams'][g].discard(term)
+            if not index['grams'][g]:
+                del index['grams'][g]
+
+
+def build_sc_index(guild):
     settings = get_serv_settings(guild.id)
+    index = {'names': {}, 'games': {}, 'channels': {}, 'terms': {}, 'grams': {}}
+    for scn, sc in settings['subcommunities'].items():
+        _index_add(index, guild, scn, sc)
+    sc_index[guild.id] = index
+    return index
+
+
+def get_sc_index(guild):
+    if guild.id in sc_index:
+        return sc_index[guild.id]
+    return build_sc_index(guild)
+
+
+def index_subcommunity(guild, scn):
+    ''' (Re)index a single SC after it was created or its games/channel changed. '''
+    if guild.id not in sc_index:
+        build_sc_index(guild)
+        return
+    index = sc_index[guild.id]
+    _index_remove(index, scn)
+    settings = get_serv_settings(guild.id)
+    if scn in settings['subcommunities']:
+        _index_add(index, guild, scn, settings['subcommunities'][scn])
+
+
+def unindex_subcommunity(guild, scn):
+    if guild.id in sc_index:
+        _index_remove(sc_index[guild.id], scn)
+
+
+# Who holds each SC role, so membership checks and player counts don't have to walk role.members (every member of
+# the guild) each time. Built from the member cache on first use and kept up to date by member update events and the
+# bot's own role changes.
+role_members = {}  # {guild_id: {role_id: set(member_id)}}
+
+
+def build_role_index(guild):
+    settings = get_serv_settings(guild.id)
+    index = {sc['role_id']: set() for sc in settings['subcommunities'].values()}
+    for m in guild.members:
+        for r in m.roles:
+            if r.id in index:
+                index[r.id].add(m.id)
+    # Members that aren't cached (yet, see lean_startup) keep the roles they had in the snapshot
+    for role_id, members in snapshot_roles.pop(guild.id, {}).items():
+        if role_id in index and not guild.chunked:
+            index[role_id].update(mid for mid in members if guild.get_member(mid) is None)
+    role_members[guild.id] = index
+    return index
+
+
+def get_role_members(guild, role):
+    ''' IDs of the members who have the role. '''
+    index = role_members.get(guild.id)
+    if index is None:
+        index = build_role_index(guild)
+    if role.id not in index:
+        index[role.id] = set(m.id for m in role.members)  # Not an SC role when the index was built
+    return index[role.id]
+
+
+def update_role_index(guild, before, after):
+    index = role_members.get(guild.id)
+    if index is None:
+        return
+    old = set(r.id for r in before.roles)
+    new = set(r.id for r in after.roles)
+    if old == new:
+        return
+    for role_id in old - new:
+        if role_id in index:
+            index[role_id].discard(after.id)
+    for role_id in new - old:
+        if role_id in index:
+            index[role_id].add(after.id)
+
+
+def record_role_grant(guild, role, member_id):
+    if guild.id in role_members:
+        get_role_members(guild, role).add(member_id)
+
+
+def record_role_removal(guild, role, member_id):
+    if guild.id in role_members:
+        get_role_members(guild, role).discard(member_id)
 
-    for scn in settings['subcommunities']:
-        sc = settings['subcommunities'][scn]
 
-        if keyword.lower() == scn.lower():
-            return (scn, sc)
+def on_success(future, callback, *args):
+    ''' Call callback(*args) once a queued action's future finishes with a truthy result, so the role index only
+        changes for grants and removals that actually went through. '''
+    def done(f):
+        if not f.cancelled() and f.exception() is None and f.result():
+            callback(*args)
+    future.add_done_callback(done)
 
-        for g in sc['games']:
-            if keyword.lower() == g.lower():
-                return (scn, sc)
 
-        if convert_to_valid_channel_name(keyword) == guild.get_channel(sc['channel_id']):
-            return (scn, sc)
+def on_failure(future, callback, *args):
+    ''' Call callback(*args) if a queued action's future is cancelled, raises or finishes with a falsy result (the
+        action queue gave up on it). '''
+    def done(f):
+        if f.cancelled() or f.exception() is not None or not f.result():
+            callback(*args)
+    future.add_done_callback(done)
 
-    return (None, None)  # Couldn't find SC
+
+def lookup_subcommunity(index, keyword):
+    kw = keyword.casefold()
+    return index['names'].get(kw) or index['games'].get(kw) or index['channels'].get(channel_name_key(keyword))
+
+
+def fuzzy_find_subcommunities(guild, keyword, limit=3, min_score=0.4):
+    ''' Names of the SCs whose name or a game alias is most similar to keyword (by shared trigrams), best first. '''
+    settings = get_serv_settings(guild.id)
+    index = get_sc_index(guild)
+    grams = trigrams(keyword)
+    if not grams:
+        return []
+    # To reach min_score a term has to share at least min_shared trigrams with the keyword, so it must have one of
+    # the rarest len(grams) - min_shared + 1 of them. Only those are used to find candidates, common trigrams like
+    # " th" would otherwise make every lookup touch most of the terms.
+    min_shared = max(1, int(min_score * len(grams) / (2 - min_score) + 0.999))
+    rarest = sorted(grams, key=lambda g: len(index['grams'].get(g, ())))[:len(grams) - min_shared + 1]
+    scores = {}
+    for term in set(itertools.chain.from_iterable(index['grams'].get(g, ()) for g in rarest)):
+        scn, term_grams = index['terms'][term]
+        score = 2.0 * len(grams & term_grams) / (len(grams) + len(term_grams))
+        if score >= min_score and score > scores.get(scn, 0) and scn in settings['subcommunities']:
+            scores[scn] = score
+    return sorted(scores, key=lambda scn: (-scores[scn], scn))[:limit]
+
+
+def not_found_text(guild, keyword):
+    text = "Couldn't find any subcommunity using the keyword `" + keyword + "`."
+    suggestions = fuzzy_find_subcommunities(guild, keyword)
+    if suggestions:
+        text += " Did you mean " + " or ".join("**" + scn + "**" for scn in suggestions) + "?"
+    return text
+
+
+@instrumented('find_subcommunity')
+async def find_subcommunity(guild, keyword):
+    ''' Return a tuple of (name, subcommunity) from a given keyword by matching SC name, game name and channel name. '''
+
+    settings = get_serv_settings(guild.id)
+
+    scn = lookup_subcommunity(get_sc_index(guild), keyword)
+    if scn is None:
+        return (None, None)  # Couldn't find SC
+    if scn not in settings['subcommunities']:
+        # Settings changed behind the index's back, rebuild it and try again
+        scn = lookup_subcommunity(build_sc_index(guild), keyword)
+        if scn is None:
+            return (None, None)
+    return (scn, settings['subcommunities'][scn])
 
 
 async def get_wrapper_cat(guild):
@@ -219,19 +985,41 @@ async def initialize_server(guild):
     print("ini end")
 
 
+creating_subcommunities = {}  # {(guild_id, game_name): asyncio.Task}
+
+
 async def create_subcommunity(guild, gname, reply_channel=None):
+    ''' Create the role, channel and settings record of a new SC. This is shielded from cancellation (e.g. by
+        'guild_timeout') so it's never left half done, and a retry for the same game waits for the running one. '''
+    key = (guild.id, gname)
+    if key not in creating_subcommunities:
+        task = asyncio.ensure_future(_create_subcommunity(guild, gname, reply_channel))
+        creating_subcommunities[key] = task
+        task.add_done_callback(lambda t: creating_subcommunities.pop(key, None))
+    return await asyncio.shield(creating_subcommunities[key])
+
+
+async def _create_subcommunity(guild, gname, reply_channel=None):
     # Create role
     role_name = "Plays: " + gname
-    role = await guild.create_role(name=role_name)
+    role = await queue_action(guild, 'create_role', guild.create_role, name=role_name)
+    if role is None:
+        return None
 
     # Create channel
     wrapper = await get_wrapper_cat(guild)
     cname = convert_to_valid_channel_name(gname)
-    channel = await guild.create_text_channel(cname, category=wrapper)
-    await channel.set_permissions(guild.default_role, read_messages=False)
-    await channel.set_permissions(role, read_messages=True)
+    channel = await queue_action(guild, 'create_channel', guild.create_text_channel, cname, category=wrapper)
+    if channel is None:
+        await queue_action(guild, 'delete_role', role.delete)  # Don't leave a role behind without its SC
+        return None
+    await queue_action(guild, 'edit_permissions:' + str(channel.id),
+                       channel.set_permissions, guild.default_role, read_messages=False)
+    await queue_action(guild, 'edit_permissions:' + str(channel.id),
+                       channel.set_permissions, role, read_messages=True)
     if reply_channel:
-        await reply_channel.send("Created subcommunity for `" + gname + "` :smiley:")
+        queue_action(guild, 'send_message:' + str(reply_channel.id),
+                     reply_channel.send, "Created subcommunity for `" + gname + "` :smiley:")
 
     settings = get_serv_settings(guild.id)
 
@@ -239,15 +1027,22 @@ async def create_subcommunity(guild, gname, reply_channel=None):
     text = "This channel for **" + gname + "** was just created automatically, have fun! :)"
     if "subcommunity_announcement" in settings:
         text = settings["subcommunity_announcement"].replace("##game_name##", gname)
-    await channel.send(text)
+    queue_action(guild, 'send_message:' + str(channel.id), channel.send, text)
 
     # Add record to json
     if gname not in settings['subcommunities']:
-        settings['subcommunities'][gname] = default_sc_dict
-        settings['subcommunities'][gname]["role_id"] = role.id
-        settings['subcommunities'][gname]["channel_id"] = channel.id
-        settings['subcommunities'][gname]["games"] = [gname]
+        sc = dict(default_sc_dict)
+        sc["role_id"] = role.id
+        sc["channel_id"] = channel.id
+        sc["games"] = [gname]
+        sc["users_who_left"] = set()
+        settings['subcommunities'][gname] = sc
+        if guild.id in role_members:
+            role_members[guild.id][role.id] = set()
         set_serv_settings(guild.id, settings)
+        index_subcommunity(guild, gname)
+        # Add the people already playing it on the next tick, they won't come up again until they change game
+        changed_games.setdefault(guild.id, set()).update(g for g in sc['games'] if g in game_players.get(guild.id, {}))
 
     await update_info_message(guild)
 
@@ -263,7 +1058,7 @@ async def remove_subcommunity(guild, channel=None, gname=None):
             channel = guild.get_channel(sc['channel_id'])
         else:
             if channel:
-                await channel.send("Couldn't find any subcommunity using the keyword `" + gname + "`.")
+                await channel.send(not_found_text(guild, gname))
             return False
 
     if channel is not None:
@@ -278,14 +1073,16 @@ async def remove_subcommunity(guild, channel=None, gname=None):
             # Remove role
             for r in guild.roles:
                 if r.id == sc["role_id"]:
-                    await r.delete()
+                    await queue_action(guild, 'delete_role', r.delete)
 
             # Remove channel
-            await channel.delete()
+            await queue_action(guild, 'delete_channel', channel.delete)
 
             # Remove record from json
             del settings['subcommunities'][scn]
             set_serv_settings(guild.id, settings)
+            unindex_subcommunity(guild, scn)
+            role_members.get(guild.id, {}).pop(sc["role_id"], None)
             await update_info_message(guild)
             return True
         else:
@@ -295,6 +1092,131 @@ async def remove_subcommunity(guild, channel=None, gname=None):
     return False
 
 
+async def merge_subcommunities(guild, old_name, new_name, channel):
+    ''' Fold one SC into another: its game names and opt-outs are added to the surviving SC, its members are given
+        the surviving role in paced batches, then its channel and role are deleted. If any of them couldn't be moved,
+        the old SC is kept so a re-run can finish the merge. '''
+    settings = get_serv_settings(guild.id)
+    old_scn, old_sc = await find_subcommunity(guild, old_name)
+    if not old_sc:
+        await channel.send(not_found_text(guild, old_name))
+        return False
+    new_scn, new_sc = await find_subcommunity(guild, new_name)
+    if not new_sc:
+        await channel.send(not_found_text(guild, new_name))
+        return False
+    if old_scn == new_scn:
+        await channel.send("`" + old_name + "` and `" + new_name + "` are already the same subcommunity.")
+        return False
+    new_role = guild.get_role(new_sc['role_id'])
+    if new_role is None:
+        await channel.send("It seems the role for **" + new_scn + "** no longer exists :(")
+        return False
+
+    # Move everyone with the old role who hasn't opted out of the surviving SC
+    old_role = guild.get_role(old_sc['role_id'])
+    movers = []
+    if old_role is not None:
+        moving = get_role_members(guild, old_role) - get_role_members(guild, new_role) - new_sc['users_who_left']
+        movers = [m for m in (guild.get_member(mid) for mid in sorted(moving)) if m is not None]
+    log("Merging {} into {}, moving {} members".format(old_scn, new_scn, len(movers)), guild, action='merge')
+    progress = await channel.send("Merging **{}** into **{}**: moving {} members...".format(
+        old_scn, new_scn, len(movers)))
+    batch_size = config.get('merge_batch_size', 50)
+    moved = 0
+    failed = []
+    for i in range(0, len(movers), batch_size):
+        batch = movers[i:i + batch_size]
+        # Each add goes through the guild's action queue, which paces them to the add_role rate limit
+        results = await asyncio.gather(*[queue_action(guild, 'add_role', grant_role, m, new_role,
+                                                      key=('add_role', m.id, new_role.id)) for m in batch],
+                                       return_exceptions=True)
+        for m, r in zip(batch, results):
+            if r is True:
+                record_role_grant(guild, new_role, m.id)
+                moved += 1
+            else:
+                failed.append(m)
+        await queue_action(guild, 'edit_message:' + str(channel.id), progress.edit,
+                           content="Merging **{}** into **{}**: moved {}/{} members...".format(
+                               old_scn, new_scn, moved, len(movers)),
+                           key=('merge_progress', progress.id))
+
+    if failed:
+        # Keep the old SC so nobody loses access, running the merge again only moves the members that are left
+        names = ', '.join(m.display_name for m in failed[:20]) + (", ..." if len(failed) > 20 else "")
+        text = ("Couldn't move {}/{} members of **{}** into **{}**: {}. **{}** was kept, run the merge again to "
+                "finish it.".format(len(failed), len(movers), old_scn, new_scn, names, old_scn))
+        await queue_action(guild, 'edit_message:' + str(channel.id), progress.edit, content=text,
+                           key=('merge_progress', progress.id))
+        log(text, guild, action='merge')
+        return False
+
+    # Delete the old channel and role
+    old_channel = guild.get_channel(old_sc['channel_id'])
+    if old_channel is not None:
+        await queue_action(guild, 'delete_channel', old_channel.delete)
+    if old_role is not None:
+        await queue_action(guild, 'delete_role', old_role.delete)
+        role_members.get(guild.id, {}).pop(old_role.id, None)
+
+    # One settings write and one games list refresh for the whole merge
+    known = set(g.casefold() for g in new_sc['games'])
+    new_sc['games'] += [g for g in old_sc['games'] if g.casefold() not in known]
+    new_sc['users_who_left'] |= old_sc['users_who_left'] - get_role_members(guild, new_role)
+    del settings['subcommunities'][old_scn]
+    set_serv_settings(guild.id, settings)
+    unindex_subcommunity(guild, old_scn)
+    index_subcommunity(guild, new_scn)
+    changed_games.setdefault(guild.id, set()).update(g for g in old_sc['games'] if g in game_players.get(guild.id, {}))
+    await update_info_message(guild)
+
+    text = "Merged **{}** into **{}**: moved {}/{} members.".format(old_scn, new_scn, moved, len(movers))
+    await queue_action(guild, 'edit_message:' + str(channel.id), progress.edit, content=text,
+                       key=('merge_progress', progress.id))
+    log(text, guild, action='merge')
+    return True
+
+
+pending_welcomes = {}  # {guild_id: {channel_id: (scn, [members])}}, auto-joins waiting to be welcomed in a digest
+
+
+async def get_instructions_jump_url(guild):
+    msg = await get_info_message(guild)
+    return msg.jump_url if msg is not None else ""
+
+
+async def send_welcome_digests(guild):
+    ''' Welcome everyone who was automatically added during this tick, with one embed per channel. '''
+    pending = pending_welcomes.pop(guild.id, {})
+    if not pending:
+        return
+    settings = get_serv_settings(guild.id)
+    jump_url = await get_instructions_jump_url(guild)
+    for channel_id, (scn, users) in pending.items():
+        wc = guild.get_channel(channel_id)
+        sc = settings['subcommunities'].get(scn)
+        if wc is None or sc is None:
+            continue
+        for i in range(0, len(users), 40):  # Keep each embed well within Discord's length limits
+            batch = users[i:i + 40]
+            e = discord.Embed(color=discord.Color.from_rgb(205, 220, 57))
+            names = ', '.join(u.display_name for u in batch)
+            if len(names) > 100:
+                names = "{} new players".format(len(batch))
+            e.title = settings['welcome'].replace("#USER#", names).replace("#GNAME#", scn)[:256]
+            e.description = ("{} {} added automatically because this is the first time we noticed them "
+                             "playing {}.\n[More info.]({})".format(
+                                 ', '.join(u.mention for u in batch),
+                                 "was" if len(batch) == 1 else "were",
+                                 ' / '.join(sc['games']),
+                                 jump_url
+                             ))
+            if len(batch) == 1:
+                e.set_thumbnail(url=batch[0].avatar_url_as(size=128))
+            queue_action(guild, 'send_message:' + str(wc.id), wc.send, embed=e)
+
+
 async def join_subcommunity(guild, gname, user, channel=None, auto=False, role=None):
     settings = get_serv_settings(guild.id)
 
@@ -306,38 +1228,48 @@ async def join_subcommunity(guild, gname, user, channel=None, auto=False, role=N
                 if r.id == sc["role_id"]:
                     role = r
                     break
-        if role is None and not auto:
-            await channel.send("It seems the role for that game no longer exists :(")
+        if role is None:
+            if not auto:
+                await channel.send("It seems the role for that game no longer exists :(")
             return False
 
-        if auto and user in role.members:
+        if auto and user.id in get_role_members(guild, role):
             return True
 
         if user.id in sc["users_who_left"]:
-            sc["users_who_left"].remove(user.id)
-        settings["subcommunities"][scn] = sc
-        set_serv_settings(guild.id, settings)
-        log(str(user.id) + " joined " + scn, guild)
+            sc["users_who_left"].discard(user.id)
+            set_serv_settings(guild.id, settings)
+        log(str(user.id) + " joined " + scn, guild, user=user.id, action='join')
 
         if role:
-            await user.add_roles(role)
+            joined = queue_action(guild, 'add_role', grant_role, user, role, key=('add_role', user.id, role.id))
+            on_success(joined, record_role_grant, guild, role, user.id)
+            if auto:
+                # update_subcommunities has already taken the game off changed_games, put it back to try again
+                on_failure(joined, mark_game_changed, guild, gname)
+            if not auto and not await joined:
+                await channel.send("There was an error giving you permissions to the requested subcommunity :cry: " +
+                                   "Please poke an admin so that they can look into it.")
+                return False
             if 'welcome' in settings and settings['welcome'] is not None:
                 wc = guild.get_channel(sc['channel_id'])
                 if wc:
-                    e = discord.Embed(color=discord.Color.from_rgb(205, 220, 57))
-                    instructions_message = await guild.get_channel(settings['instructions_channel']).fetch_message(
-                        settings['instructions_message'])
-                    e.title = settings['welcome'].replace("#USER#", user.display_name).replace("#GNAME#", scn)
-                    e.description = ("{} was added automatically because this is the first time we noticed them "
-                                     "playing {}.\n[More info.]({})".format(
-                                         user.mention,
-                                         ' / '.join(sc['games']),
-                                         instructions_message.jump_url
-                                     ))
-                    if not auto:
-                        e.description = "{} added themselves manually using the join command.".format(user.mention)
-                    e.set_thumbnail(url=user.avatar_url_as(size=128))
-                    await wc.send(embed=e)
+                    if auto and config.get('welcome_digest', False):
+                        # Sent as one embed per channel at the end of the update tick, see send_welcome_digests
+                        pending_welcomes.setdefault(guild.id, {}).setdefault(wc.id, (scn, []))[1].append(user)
+                    else:
+                        e = discord.Embed(color=discord.Color.from_rgb(205, 220, 57))
+                        e.title = settings['welcome'].replace("#USER#", user.display_name).replace("#GNAME#", scn)
+                        e.description = ("{} was added automatically because this is the first time we noticed them "
+                                         "playing {}.\n[More info.]({})".format(
+                                             user.mention,
+                                             ' / '.join(sc['games']),
+                                             await get_instructions_jump_url(guild)
+                                         ))
+                        if not auto:
+                            e.description = "{} added themselves manually using the join command.".format(user.mention)
+                        e.set_thumbnail(url=user.avatar_url_as(size=128))
+                        queue_action(guild, 'send_message:' + str(wc.id), wc.send, embed=e)
         else:
             if not auto:
                 await channel.send("There was an error giving you permissions to the requested subcommunity :cry: " +
@@ -348,7 +1280,7 @@ async def join_subcommunity(guild, gname, user, channel=None, auto=False, role=N
         return True
     else:
         if not auto:
-            await channel.send("Couldn't find any subcommunity using the keyword `" + gname + "`.")
+            await channel.send(not_found_text(guild, gname))
             return False
 
 
@@ -370,78 +1302,802 @@ async def leave_subcommunity(guild, user, channel, gname=None):
             if r.id == sc["role_id"]:
                 role = r
                 break
-        if role and user.id in role.members:
-            await user.remove_roles(role)
-            sc["users_who_left"].append(user.id)
+        if role and user.id in get_role_members(guild, role):
+            if not await queue_action(guild, 'remove_role', revoke_role, user, role,
+                                      key=('remove_role', user.id, role.id)):
+                await channel.send("There was an error removing you from that subcommunity :cry: " +
+                                   "Please poke an admin so that they can look into it.")
+                return
+            record_role_removal(guild, role, user.id)
+            sc["users_who_left"].add(user.id)
             settings["subcommunities"][scn] = sc
             set_serv_settings(guild.id, settings)
-            log(str(user.id) + " left " + scn, guild)
+            log(str(user.id) + " left " + scn, guild, user=user.id, action='leave')
         else:
             await channel.send("It looks like you aren't in that subcommunity.")
 
         await update_info_message(guild)
     else:
-        await channel.send("Couldn't find any subcommunity using the keyword `" + gname + "`.")
+        await channel.send(not_found_text(guild, gname))
     return
 
 
+# Incremental presence tracking, fed by member update events so that update_subcommunities doesn't need to walk
+# every member of the guild each tick. A full rescan only happens the first time a guild is seen after (re)connecting.
+game_players = {}  # {guild_id: {game_name: set(member_id)}}
+member_games = {}  # {guild_id: {member_id: game_name}}
+changed_games = {}  # {guild_id: set(game_name)} - games whose players changed since the last tick
+presence_synced = set()  # IDs of guilds that had a full rescan
+
+
+# Activities that never count as games, e.g. "Spotify" or "Visual Studio Code": the 'ignore_games' config list for
+# all guilds plus each guild's 'blacklist' setting. Entries are case insensitive names, or patterns with * and ?
+# wildcards. Both lists are compiled into one matcher per guild, so checking an activity costs a set lookup and at
+# most one regex match, before it is counted anywhere.
+ignore_matchers = {}  # {guild_id: (set(casefolded name), compiled pattern or None)}
+
+
+def compile_ignore_list(entries):
+    names = set()
+    patterns = []
+    for entry in entries:
+        entry = entry.casefold()
+        if any(c in entry for c in '*?['):
+            patterns.append(fnmatch.translate(entry))
+        else:
+            names.add(entry)
+    return names, re.compile('|'.join(patterns)) if patterns else None
+
+
+def is_ignored(guild_id, gname):
+    if guild_id not in ignore_matchers:
+        ignore_matchers[guild_id] = compile_ignore_list(
+            config.get('ignore_games', []) + get_serv_settings(guild_id).get('blacklist', []))
+    names, pattern = ignore_matchers[guild_id]
+    gname = gname.casefold()
+    return gname in names or (pattern is not None and pattern.match(gname) is not None)
+
+
+def get_member_game(m):
+    if m.activity and not m.bot:
+        if m.activity.type == discord.ActivityType.playing:
+            if is_ignored(m.guild.id, m.activity.name):
+                return None
+            return sys.intern(m.activity.name)  # One copy of each name in member_games, however many play it
+    return None
+
+
+def track_member(guild, member, gname):
+    players = game_players.setdefault(guild.id, {})
+    games = member_games.setdefault(guild.id, {})
+    changed = changed_games.setdefault(guild.id, set())
+
+    old_gname = games.get(member.id)
+    if old_gname == gname:
+        return
+    if old_gname is not None:
+        players[old_gname].discard(member.id)
+        if not players[old_gname]:
+            del players[old_gname]
+        changed.add(old_gname)
+        del games[member.id]
+    if gname is not None:
+        players.setdefault(gname, set()).add(member.id)
+        games[member.id] = gname
+        changed.add(gname)
+
+
+def rescan_guild_presence(guild):
+    # Player counts to reconcile with: from before the rescan, or from the snapshot if the bot just restarted
+    counts = snapshot_counts.pop(guild.id, None)
+    if guild.id in game_players:
+        counts = {gname: len(players) for gname, players in game_players[guild.id].items()}
+    pending = changed_games.pop(guild.id, set())
+
+    game_players[guild.id] = {}
+    member_games[guild.id] = {}
+    for m in guild.members:
+        gname = get_member_game(m)
+        if gname is not None:
+            track_member(guild, m, gname)
+    if counts is None:
+        mark_all_games_changed(guild)
+    else:
+        changed_games[guild.id] = pending | unreconciled_games(guild, counts)
+    presence_synced.add(guild.id)
+
+
+def mark_all_games_changed(guild):
+    changed_games.setdefault(guild.id, set()).update(game_players.get(guild.id, {}))
+
+
+def mark_game_changed(guild, gname):
+    changed_games.setdefault(guild.id, set()).add(gname)
+
+
+# Warm restarts: what the bot worked out about each guild is saved to a snapshot now and then and at shutdown, so
+# after a restart only the games whose players differ from the snapshot need to go through update_subcommunities.
+snapshot_counts = {}  # {guild_id: {game_name: player count}} from the snapshot, until each guild's first rescan
+snapshot_roles = {}  # {guild_id: {role_id: set(member_id)}} from the snapshot, until each guild's role index is built
+
+
+def unreconciled_games(guild, counts):
+    ''' Games whose player count differs from counts, or that have players who don't have the SC role yet. '''
+    settings = get_serv_settings(guild.id)
+    index = get_sc_index(guild)
+    changed = set()
+    for gname, players in game_players.get(guild.id, {}).items():
+        if counts.get(gname) != len(players):
+            changed.add(gname)
+            continue
+        sc = settings['subcommunities'].get(lookup_subcommunity(index, gname))
+        role = guild.get_role(sc['role_id']) if sc is not None else None
+        if role is not None and players - get_role_members(guild, role) - sc['users_who_left']:
+            changed.add(gname)
+    return changed
+
+
+def get_snapshot_path():
+    return os.path.join(script_dir, 'snapshots', shard_key + '.json.gz')
+
+
+def save_snapshot():
+    data = {"time": time.time(), "guilds": {}}
+    guild_ids = set(game_players) | set(role_members) | set(info_message_text) | set(channel_activity)
+    for gid in guild_ids | set(snapshot_counts) | set(snapshot_roles):
+        # Guilds that haven't been rescanned or indexed since the last snapshot was loaded carry it forward, otherwise
+        # saving soon after a restart would throw away everything the previous run knew about them.
+        if gid in snapshot_counts:
+            games = snapshot_counts[gid]
+        else:
+            games = {gname: len(players) for gname, players in game_players.get(gid, {}).items()}
+        data['guilds'][gid] = {
+            "games": games,
+            "roles": snapshot_roles[gid] if gid in snapshot_roles else role_members.get(gid, {}),
+            "info": info_message_text.get(gid),
+            "activity": channel_activity.get(gid, {}),
+        }
+    fp = get_snapshot_path()
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with gzip.open(fp + '.tmp', 'wt', encoding='utf8') as f:
+        json.dump(data, f, separators=(',', ':'), default=sorted)
+    os.replace(fp + '.tmp', fp)  # Never leave a half written snapshot behind
+
+
+def load_snapshot():
+    fp = get_snapshot_path()
+    if not os.path.exists(fp):
+        return
+    try:
+        with gzip.open(fp, 'rt', encoding='utf8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        log("Couldn't read the snapshot, starting from scratch: " + str(e), action='snapshot')
+        return
+    age = time.time() - data['time']
+    # Channel activity decays with its own half-life, so it's worth keeping however old the snapshot is
+    for gid, g in data['guilds'].items():
+        if g.get('activity'):
+            channel_activity[int(gid)] = {int(ch_id): entry for ch_id, entry in g['activity'].items()}
+            activity_restored.add(int(gid))
+    if age > config.get('snapshot_max_age', 3600):
+        log("Ignoring the snapshot, it's {:.0f}s old".format(age), action='snapshot')
+        return
+    for gid, g in data['guilds'].items():
+        gid = int(gid)
+        if g['games']:
+            snapshot_counts[gid] = g['games']
+        snapshot_roles[gid] = {int(role_id): set(members) for role_id, members in g['roles'].items()}
+        if g['info'] is not None:
+            info_message_text[gid] = g['info']
+    log("Loaded a snapshot of {} guilds from {:.0f}s ago".format(len(data['guilds']), age), action='snapshot')
+
+
+@loop(seconds=config.get('snapshot_interval', 300) or 300)
+async def snapshot_loop():
+    save_snapshot()
+
+
+@snapshot_loop.before_loop
+async def before_snapshot_loop():
+    # tasks.loop runs its first iteration straight away, before any guild has been rescanned
+    await asyncio.sleep(snapshot_loop.seconds)
+
+
+class TraceRecorder:
+    ''' Records what a guild sees - presence snapshots each update tick and gc- commands - to a gzipped JSON lines
+        file, which replay.py can play back deterministically against a fake guild.
+
+    The first line describes the guild (settings, members, role holders and channel names), after that each tick only
+    records the members whose game changed since the previous tick.
+    '''
+
+    def __init__(self, guild):
+        d = os.path.join(script_dir, config.get('trace_dir', 'traces'))
+        os.makedirs(d, exist_ok=True)
+        self.fp = os.path.join(d, "{}-{}.jsonl.gz".format(guild.id, datetime.utcnow().strftime("%Y%m%d-%H%M%S")))
+        self.f = gzip.open(self.fp, 'wt', encoding='utf8')
+        self.start = time.time()
+        self.last = {}  # {member_id: game} as of the last recorded tick
+        settings = get_serv_settings(guild.id)
+        role_ids = set(sc['role_id'] for sc in settings['subcommunities'].values())
+        channel_ids = [sc['channel_id'] for sc in settings['subcommunities'].values()]
+        channel_ids += [settings['instructions_channel'], settings['wrapper_category']]
+        self.write({
+            "e": "start",
+            "time": datetime.utcnow().isoformat(),
+            "guild": guild.id,
+            "settings": settings,
+            "members": [m.id for m in guild.members if not m.bot],
+            "roles": {r.id: [m.id for m in r.members] for r in guild.roles if r.id in role_ids},
+            "channels": {ch.id: ch.name for ch in (guild.get_channel(i) for i in channel_ids) if ch is not None},
+        })
+
+    def write(self, event):
+        self.f.write(json.dumps(event, separators=(',', ':'), default=sorted) + '\n')
+
+    def record_tick(self, guild):
+        games = member_games.get(guild.id, {})
+        changed = {mid: g for mid, g in games.items() if self.last.get(mid) != g}
+        cleared = [mid for mid in self.last if mid not in games]
+        self.write({"e": "tick", "t": round(time.time() - self.start, 3), "set": changed, "clr": cleared})
+        self.last = dict(games)
+        self.f.flush()
+
+    def record_command(self, message):
+        self.write({"e": "cmd", "t": round(time.time() - self.start, 3), "author": message.author.id,
+                    "channel": message.channel.id, "content": message.content})
+
+    def close(self):
+        self.f.close()
+
+
+trace_recorders = {}  # {guild_id: TraceRecorder}, for the guilds listed in 'trace_guilds'
+
+
+def close_trace_recorders():
+    for recorder in trace_recorders.values():
+        recorder.close()
+
+
+atexit.register(close_trace_recorders)
+
+
+@instrumented('update_subcommunities')
 async def update_subcommunities(guild, channel=None):
     settings = get_serv_settings(guild.id)
     if not settings['enabled']:
         return
 
-    admin_channel = await get_admin_channel(guild)
-
-    # Check for new games and create communities for them
-    games_dict = {}
-    for m in guild.members:
-        if m.activity and not m.bot:
-            if m.activity.type == discord.ActivityType.playing:
-                gname = m.activity.name
-                if gname in games_dict:
-                    games_dict[gname].append(m)
-                else:
-                    games_dict[gname] = [m]
-    for gname in games_dict:
-        scn, sc = await find_subcommunity(guild, gname)
-        if len(games_dict[gname]) >= settings["playerthreshold"]:
-            if not sc:
-                await create_subcommunity(guild, gname, admin_channel)
-            # else:
-            #     for r in guild.roles:
-            #         if r.id == sc["role_id"]:
-            #             role = r
-            #             break
-        if sc:
-            role = None
-            for r in guild.roles:
-                if r.id == sc["role_id"]:
-                    role = r
-                    break
-            for m in games_dict[gname]:
-                if m.id not in sc["users_who_left"]:
-                    await join_subcommunity(guild, gname, m, auto=True, role=role)
+    if guild.id not in presence_synced:
+        rescan_guild_presence(guild)
+    if guild.id in config.get('trace_guilds', []):
+        if guild.id not in trace_recorders:
+            trace_recorders[guild.id] = TraceRecorder(guild)
+        trace_recorders[guild.id].record_tick(guild)
+    changed = changed_games.get(guild.id, set())
+    changed_games[guild.id] = set()
+    if not changed:
+        return
 
-    # TODO Order channels by activity
-    # for scn in settings['subcommunities']:
-    #     sc = settings['subcommunities'][scn]
-    #     ch = guild.get_channel(sc['channel_id'])
-    #     if ch.category:  # must be inside the wrapper category
-    #         ch.edit
+    # If the update fails or is cancelled (see 'guild_timeout'), the games it didn't finish are retried next tick
+    remaining = set(changed)
+    try:
+        admin_channel = await get_admin_channel(guild)
+
+        # Check for new games and create communities for them
+        players = game_players.get(guild.id, {})
+        for gname in changed:
+            if gname not in players:
+                remaining.discard(gname)
+                continue  # Nobody is playing it anymore
+            scn, sc = await find_subcommunity(guild, gname)
+            if len(players[gname]) >= settings["playerthreshold"]:
+                if not sc:
+                    await create_subcommunity(guild, gname, admin_channel)
+                    scn, sc = await find_subcommunity(guild, gname)
+            if sc:
+                role = guild.get_role(sc["role_id"])
+                # Only look up the members that haven't opted out, by ID
+                for mid in players[gname] - sc["users_who_left"]:
+                    m = guild.get_member(mid)
+                    if m is not None:
+                        await join_subcommunity(guild, gname, m, auto=True, role=role)
+            remaining.discard(gname)
+    finally:
+        changed_games.setdefault(guild.id, set()).update(remaining)
+
+    await send_welcome_digests(guild)
 
     return
 
 
+update_stats = {
+    "ticks": 0,
+    "overruns": 0,
+    "timeouts": 0,
+    "scans": 0,
+    "skipped": 0,
+    "deferred": 0,
+    "last_tick": 0.0,
+}
+
+
+def owns_guild(guild):
+    ''' Whether this process is responsible for the guild, when running shard groups as separate processes. '''
+    if shard_ids is None:
+        return True
+    return (guild.id >> 22) % shard_count in shard_ids
+
+
+async def update_guild(guild, semaphore=None):
+    timeout = config.get('guild_timeout', 0)
+    if semaphore is not None:
+        async with semaphore:
+            return await update_guild(guild)
+    try:
+        if timeout:
+            await asyncio.wait_for(update_subcommunities(guild, None), timeout)
+        else:
+            await update_subcommunities(guild, None)
+    except asyncio.TimeoutError:
+        update_stats['timeouts'] += 1
+        log("Update took longer than {}s, skipping until next tick".format(timeout), guild, action='update')
+
+
+# Adaptive scan scheduling: instead of scanning every guild every background_interval, each guild gets its own next
+# scan time based on its size and how often its games have been changing, and only the guilds that are due are
+# scanned (at most scans_per_second of them).
+scan_queue = []  # Heap of (next_scan_time, guild_id)
+# {guild_id: {"rate": changed games per second (moving average), "last": time of the last scan,
+#             "next": time of the next scan, scan_queue entries for any other time are stale and skipped}}
+scan_state = {}
+scan_budget = {
+    "tokens": 0.0,
+    "time": 0.0,
+}
+
+
+def get_update_interval():
+    if config.get('adaptive_scan', False):
+        return float(config.get('scan_tick', 1))
+    return float(config['background_interval'])
+
+
+def get_max_scan_interval():
+    return float(config.get('scan_max_interval', config['background_interval'] * 12))
+
+
+def scan_interval(guild, state):
+    ''' Seconds until the guild should be scanned again. Guilds with pending changes are scanned every
+        scan_min_interval, others less often the quieter and smaller they are, up to scan_max_interval. '''
+    min_interval = float(config.get('scan_min_interval', config['background_interval']))
+    max_interval = get_max_scan_interval()
+    if changed_games.get(guild.id):
+        return min_interval
+    size = ((guild.member_count or 0) / config.get('scan_size_reference', 1000)) ** 0.5
+    return max(min_interval, max_interval / (1 + state['rate'] * max_interval + size))
+
+
+def due_guilds(client):
+    ''' Take the guilds that are due a scan off the schedule, within the scan budget, and schedule their next scan. '''
+    now = time.monotonic()
+    for g in client.guilds:
+        if g.id not in scan_state and owns_guild(g):
+            scan_state[g.id] = {"rate": 0.0, "last": now, "next": now}
+            heapq.heappush(scan_queue, (now, g.id))
+
+    budget = config.get('scans_per_second', 0)
+    if budget:
+        scan_budget['tokens'] = min(max(1.0, budget), scan_budget['tokens'] + (now - scan_budget['time']) * budget)
+        scan_budget['time'] = now
+
+    due = []
+    while scan_queue and scan_queue[0][0] <= now:
+        when, gid = scan_queue[0]
+        if gid not in scan_state or scan_state[gid]['next'] != when:
+            heapq.heappop(scan_queue)  # Superseded by an earlier entry, e.g. when the guild was re-enabled
+            continue
+        guild = client.get_guild(gid)
+        if guild is None:
+            scan_state.pop(heapq.heappop(scan_queue)[1], None)
+            continue
+        state = scan_state[guild.id]
+        if guild_enabled.get(guild.id) is False:
+            state['next'] = now + get_max_scan_interval()
+            heapq.heapreplace(scan_queue, (state['next'], guild.id))
+            update_stats['skipped'] += 1
+            continue
+        if budget:
+            if scan_budget['tokens'] < 1:
+                update_stats['deferred'] += 1  # The rest are still due and will be first in line next tick
+                break
+            scan_budget['tokens'] -= 1
+
+        changes = len(changed_games.get(guild.id, ()))
+        state['rate'] = state['rate'] * 0.7 + changes / max(1.0, now - state['last']) * 0.3
+        state['last'] = now
+        state['next'] = now + scan_interval(guild, state)
+        heapq.heapreplace(scan_queue, (state['next'], guild.id))
+        due.append(guild)
+    return due
+
+
 @loop(seconds=config['background_interval'])
 async def update_loop(client):
     if not client.is_ready():
         return
 
+    start = time.monotonic()
+    if config.get('adaptive_scan', False):
+        guilds = due_guilds(client)
+    else:
+        guilds = [g for g in client.guilds if owns_guild(g)]
+    concurrency = config.get('concurrent_guilds', 1)
+    if concurrency > 1:
+        semaphore = asyncio.Semaphore(concurrency)
+        results = await asyncio.gather(*[update_guild(g, semaphore) for g in guilds], return_exceptions=True)
+        for g, r in zip(guilds, results):
+            if isinstance(r, Exception):
+                log("Update failed", g, exc_info=r)
+    else:
+        for g in guilds:
+            await update_guild(g)
+
+    elapsed = time.monotonic() - start
+    update_stats['ticks'] += 1
+    update_stats['last_tick'] = elapsed
+    update_stats['scans'] += len(guilds)
+    interval = get_update_interval()
+    if elapsed > interval:
+        update_stats['overruns'] += 1
+        log("Update tick took {:.1f}s, longer than the {}s interval ({} overruns so far)".format(
+            elapsed, interval, update_stats['overruns']), action='update', latency='{:.3f}'.format(elapsed))
+
+
+async def purge_instructions_channel(guild):
+    ''' Delete everything older than 24h in the instructions channel, except the games list itself.
+        Only messages newer than the last purge point are looked at. '''
+    settings = get_serv_settings(guild.id)
+    ch = guild.get_channel(settings['instructions_channel'])
+    if ch is None:
+        return
+    purged_until = settings.get('instructions_purged_until', 0)
+    if ch.last_message_id is None or ch.last_message_id <= purged_until:
+        return  # Nothing new since the last purge
+
+    now = datetime.utcnow()
+    bulk_cutoff = now - timedelta(days=14) + timedelta(hours=1)  # Bulk deletion only works on messages under 14 days
+    to_bulk_delete = []
+    to_delete = []
+    newest = purged_until
+    async for m in ch.history(limit=None, before=now - timedelta(days=1),
+                              after=discord.Object(purged_until) if purged_until else None, oldest_first=True):
+        newest = max(newest, m.id)
+        if m.id == settings['instructions_message']:
+            continue
+        if m.created_at > bulk_cutoff:
+            to_bulk_delete.append(m)
+        else:
+            to_delete.append(m)
+
+    route = 'delete_message:' + str(ch.id)
+    for i in range(0, len(to_bulk_delete), 100):
+        await queue_action(guild, route, ch.delete_messages, to_bulk_delete[i:i + 100])
+    for m in to_delete:
+        await queue_action(guild, route, m.delete)
+    if to_bulk_delete or to_delete:
+        log("Purged {} messages from the instructions channel".format(len(to_bulk_delete) + len(to_delete)), guild)
+
+    if newest != purged_until:
+        settings['instructions_purged_until'] = newest
+        set_serv_settings(guild.id, settings)
+
+
+@loop(seconds=config.get('purge_interval', 600))
+async def purge_loop(client):
+    if not client.is_ready():
+        return
+
     for g in client.guilds:
-        await update_subcommunities(g, None)
+        if owns_guild(g):
+            await catch_http_error(purge_instructions_channel, g)
+
 
+# Decaying message counters for the channels in the wrapper category: {guild_id: {channel_id: [score, last_time]}}
+channel_activity = {}
+activity_restored = set()  # Guilds whose channel_activity was loaded from a snapshot
+
+
+def decayed_activity(entry, now):
+    score, last = entry
+    return score * 0.5 ** ((now - last) / (config.get('activity_half_life', 72) * 3600))
+
+
+def record_channel_activity(guild, channel):
+    entry = channel_activity.setdefault(guild.id, {}).setdefault(channel.id, [0.0, time.time()])
+    now = time.time()
+    entry[0] = decayed_activity(entry, now) + 1
+    entry[1] = now
+
+
+async def order_channels_by_activity(guild):
+    ''' Sort the game channels in the wrapper category by recent activity, most active first, with a single bulk
+        position update - and only if the order actually changed. '''
+    settings = get_serv_settings(guild.id)
+    cat = guild.get_channel(settings['wrapper_category'])
+    if cat is None:
+        return False
+    channels = sorted(cat.channels, key=lambda c: c.position)
+    activity = channel_activity.get(guild.id, {})
+    now = time.time()
+
+    def sort_key(ch):
+        if ch.id == settings['instructions_channel']:
+            return (0, 0, '')  # The games list stays at the top
+        entry = activity.get(ch.id)
+        return (1, -decayed_activity(entry, now) if entry else 0, ch.name)
+
+    new_order = sorted(channels, key=sort_key)
+    if [c.id for c in new_order] == [c.id for c in channels]:
+        return False
+
+    # Reuse the positions the channels already have, so channels outside the category don't move
+    positions = [c.position for c in channels]
+    payload = [{"id": c.id, "position": p} for c, p in zip(new_order, positions) if c.position != p]
+    # Deliberately using discord.py's internal HTTP client: 1.x has no public API to move several channels in one
+    # request, and moving them one by one would cost a request (and a reshuffle) per channel
+    await queue_action(guild, 'edit_channel', guild._state.http.bulk_channel_update, guild.id, payload,
+                       key=('order_channels', guild.id))
+    log("Reordered {} channels by activity".format(len(payload)), guild, action='order')
+    return True
+
+
+@loop(seconds=config.get('order_interval', 3600))
+async def order_loop(client):
+    if not client.is_ready():
+        return
 
-class MyClient(discord.Client):
+    # Without a snapshot to restore from, a few messages since the restart would decide the whole order, so wait for
+    # a half-life's worth of activity first
+    warming_up = time.time() - start_time < config.get('activity_half_life', 72) * 3600
+    for g in client.guilds:
+        if warming_up and g.id not in activity_restored:
+            continue
+        if owns_guild(g) and get_serv_settings(g.id)['enabled']:
+            await catch_http_error(order_channels_by_activity, g)
+
+
+def snowflake_timestamp(snowflake):
+    ''' Unix timestamp (in seconds) of when a Discord ID was created. '''
+    return ((snowflake >> 22) + discord.utils.DISCORD_EPOCH) / 1000
+
+
+async def prune_inactive_subcommunities(guild):
+    ''' Remove SCs whose channel had no activity for 'prune_after_days' days. Channels with fewer than
+        'prune_min_players' players are removed straight away, bigger ones get a warning first and are removed if
+        there's still no activity 'prune_warning_days' days later. Returns the number of SCs removed. '''
+    settings = get_serv_settings(guild.id)
+    now = time.time()
+    inactive_after = config.get('prune_after_days', 240) * 86400
+    activity = channel_activity.get(guild.id, {})
+    removed = 0
+    for scn, sc in list(settings['subcommunities'].items()):
+        ch = guild.get_channel(sc['channel_id'])
+        if ch is None:
+            continue
+
+        if 'prune_warning' in sc:
+            if ch.last_message_id != sc['prune_warning']:
+                del sc['prune_warning']  # Someone said something since the warning
+                set_serv_settings(guild.id, settings)
+            elif now - snowflake_timestamp(sc['prune_warning']) > config.get('prune_warning_days', 7) * 86400:
+                log("Removing inactive subcommunity " + scn, guild, action='prune')
+                removed += await remove_subcommunity(guild, channel=ch)
+            continue
+
+        last_active = snowflake_timestamp(ch.last_message_id or ch.id)
+        if ch.id in activity:
+            last_active = max(last_active, activity[ch.id][1])
+        if now - last_active < inactive_after:
+            continue
+
+        role = guild.get_role(sc['role_id'])
+        players = len(get_role_members(guild, role)) if role is not None else 0
+        if players < config.get('prune_min_players', 10):
+            log("Removing inactive subcommunity {} ({} players)".format(scn, players), guild, action='prune')
+            removed += await remove_subcommunity(guild, channel=ch)
+        else:
+            warning = await queue_action(guild, 'send_message:' + str(ch.id), ch.send,
+                                         "This channel will be deleted if it still has no activity in the next "
+                                         "{} days.".format(config.get('prune_warning_days', 7)))
+            if warning is not None:
+                sc['prune_warning'] = warning.id
+                set_serv_settings(guild.id, settings)
+                log("Warned inactive subcommunity {} ({} players)".format(scn, players), guild, action='prune')
+    return removed
+
+
+prune_cursor = 0  # Where the next prune batch starts in the list of guilds
+
+
+@loop(seconds=config.get('prune_interval', 3600))
+async def prune_loop(client):
+    ''' Check 'prune_batch_size' guilds per run, so each run stays cheap however many guilds the bot is in. '''
+    global prune_cursor
+    if not client.is_ready():
+        return
+
+    guilds = sorted((g for g in client.guilds if owns_guild(g)), key=lambda g: g.id)
+    if prune_cursor >= len(guilds):
+        prune_cursor = 0
+    batch = guilds[prune_cursor:prune_cursor + config.get('prune_batch_size', 10)]
+    prune_cursor += len(batch)
+    for g in batch:
+        if config.get('lean_startup', False) and g.id not in chunked_guilds:
+            continue  # Role member counts aren't complete until the guild has been chunked
+        if get_serv_settings(g.id)['enabled']:
+            await catch_http_error(prune_inactive_subcommunities, g)
+
+
+# With 'lean_startup', member lists aren't downloaded for every guild at login. chunk_loop fetches them afterwards,
+# one guild at a time, only for enabled guilds and the busiest ones first.
+chunked_guilds = set()
+startup_stats = {
+    "ready": None,  # Seconds from starting to being logged in and ready
+    "chunked": None,  # Seconds from starting until all enabled guilds were chunked
+    "ready_mb": None,  # Resident memory when ready, before any member lists were downloaded
+    "chunked_mb": None,  # Resident memory once all enabled guilds were chunked
+}
+
+
+def get_rss_mb():
+    ''' Current resident memory of the process in MB, 0 where /proc isn't available. '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return 0.0
+
+
+@loop(seconds=config.get('chunk_interval', 2))
+async def chunk_loop(client):
+    if not client.is_ready() or startup_stats['ready'] is None:
+        return  # Wait for on_ready, which records the time and memory to compare against
+
+    pending = [g for g in client.guilds
+               if owns_guild(g) and g.id not in chunked_guilds and get_serv_settings(g.id)['enabled']]
+    if not pending:
+        if startup_stats['chunked'] is None:
+            startup_stats['chunked'] = time.time() - start_time
+            startup_stats['chunked_mb'] = get_rss_mb()
+            # Members of enabled guilds are cached once chunked, so the lasting saving is the disabled guilds'
+            # members (and voice states), the rest is only saved until chunking catches up
+            skipped = sum(g.member_count or 0 for g in client.guilds if owns_guild(g) and g.id not in chunked_guilds)
+            log("All enabled guilds chunked {:.1f}s after starting, using {:.0f} MB ({:+.0f} MB since ready), "
+                "{} members of disabled guilds not downloaded".format(
+                    startup_stats['chunked'], startup_stats['chunked_mb'],
+                    startup_stats['chunked_mb'] - startup_stats['ready_mb'], skipped), action='chunk')
+        return
+
+    guild = max(pending, key=lambda g: (len(member_games.get(g.id, ())), -(g.member_count or 0)))
+    with timed('chunk'):
+        await guild.chunk()
+    chunked_guilds.add(guild.id)
+    role_members.pop(guild.id, None)  # Rebuilt from the complete member list on next use
+    presence_synced.discard(guild.id)  # Chunked members don't fire on_member_update, rescan to pick up their games
+    log("Chunked {} members, {} guilds to go".format(guild.member_count, len(pending) - 1), guild, action='chunk')
+    await update_info_message(guild)  # Role member counts are complete now
+
+
+def format_stats():
+    text = "{:<24}{:>8}{:>9}{:>9}{:>9}{:>9}\n".format("Stage", "Calls", "p50 ms", "p90 ms", "p99 ms", "Max ms")
+    for stage in sorted(stage_stats):
+        st = stage_stats[stage]
+        p50, p90, p99, pmax = st.percentiles(0.5, 0.9, 0.99, 1.0)
+        text += "{:<24}{:>8}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}\n".format(
+            stage[:23], st.count, p50 * 1000, p90 * 1000, p99 * 1000, pmax * 1000)
+    text += "\nSettings: {} cache hits, {} reads, {} writes, {} dirty\n".format(
+        settings_stats['hits'], settings_stats['disk_reads'], settings_stats['disk_writes'], len(settings_dirty))
+    text += "Updates: {} ticks, {} overruns, {} timeouts, last tick {:.2f}s\n".format(
+        update_stats['ticks'], update_stats['overruns'], update_stats['timeouts'], update_stats['last_tick'])
+    text += "Scans: {} guilds scanned, {} disabled skipped, {} ticks over budget, {} scheduled\n".format(
+        update_stats['scans'], update_stats['skipped'], update_stats['deferred'], len(scan_state))
+    text += "Action queues: {} queued\n".format(sum(q.depth() for q in action_queues.values()))
+    text += "Startup: ready after {}, chunked after {}, {:.0f} MB resident now\n".format(
+        *["{:.1f}s ({:.0f} MB)".format(startup_stats[k], startup_stats[k + '_mb'])
+          if startup_stats[k] is not None else "-" for k in ('ready', 'chunked')],
+        get_rss_mb())
+    return text
+
+
+def format_prometheus_metrics():
+    lines = ["# TYPE gc_stage_seconds summary"]
+    for stage in sorted(stage_stats):
+        st = stage_stats[stage]
+        for q, v in zip(("0.5", "0.9", "0.99"), st.percentiles(0.5, 0.9, 0.99)):
+            lines.append('gc_stage_seconds{{stage="{}",quantile="{}"}} {}'.format(stage, q, v))
+        lines.append('gc_stage_seconds_sum{{stage="{}"}} {}'.format(stage, st.total))
+        lines.append('gc_stage_seconds_count{{stage="{}"}} {}'.format(stage, st.count))
+    lines.append("# TYPE gc_stage_errors_total counter")
+    for stage in sorted(stage_stats):
+        lines.append('gc_stage_errors_total{{stage="{}"}} {}'.format(stage, stage_stats[stage].errors))
+    lines.append("# TYPE gc_settings_total counter")
+    for k in sorted(settings_stats):
+        lines.append('gc_settings_total{{result="{}"}} {}'.format(k, settings_stats[k]))
+    lines.append("# TYPE gc_update_total counter")
+    for k in ('ticks', 'overruns', 'timeouts', 'scans', 'skipped', 'deferred'):
+        lines.append('gc_update_total{{result="{}"}} {}'.format(k, update_stats[k]))
+    lines.append("# TYPE gc_action_queue_depth gauge")
+    lines.append("gc_action_queue_depth {}".format(sum(q.depth() for q in action_queues.values())))
+    lines.append("# TYPE gc_resident_memory_megabytes gauge")
+    lines.append("gc_resident_memory_megabytes {}".format(get_rss_mb()))
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(reader, writer):
+    ''' Minimal HTTP handler answering every request with the metrics in Prometheus text format. '''
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    body = format_prometheus_metrics().encode('utf8')
+    writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n")
+    writer.write("Content-Length: {}\r\n\r\n".format(len(body)).encode('utf8') + body)
+    await writer.drain()
+    writer.close()
+
+
+metrics_server = None
+
+
+@loop(seconds=config.get('metrics_interval', 60))
+async def metrics_loop():
+    global metrics_server
+    if config.get('metrics_port') and metrics_server is None:
+        metrics_server = await asyncio.start_server(serve_metrics, '127.0.0.1', config['metrics_port'])
+    if config.get('metrics_file'):
+        fp = os.path.join(script_dir, config['metrics_file'])
+        with open(fp + '.tmp', 'w') as f:
+            f.write(format_prometheus_metrics())
+        os.replace(fp + '.tmp', fp)
+
+
+@loop(seconds=config.get('settings_flush_interval', 30))
+async def flush_loop(client):
+    flush_serv_settings()
+    if sharded and client.is_ready():
+        # Let the other shard processes (and the admin 'shards' command) know how this one is doing
+        settings_store.save_shard_status(shard_key, {
+            "pid": os.getpid(),
+            "shard_ids": shard_ids if shard_ids is not None else list(client.shards),
+            "shard_count": client.shard_count,
+            "guilds": len(client.guilds),
+            "latency": client.latency,
+            "updated": time.time(),
+        })
+
+
+def get_client_options():
+    options = {}
+    if shard_ids is not None:
+        options.update(shard_ids=shard_ids, shard_count=shard_count)
+    elif shard_count:
+        options.update(shard_count=shard_count)
+    if config.get('lean_startup', False):
+        # Only the events the bot uses, no voice state cache, and member lists are chunked later by chunk_loop
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.members = True
+        intents.presences = True
+        intents.guild_messages = True
+        intents.dm_messages = True
+        options.update(intents=intents, member_cache_flags=discord.MemberCacheFlags(voice=False),
+                       chunk_guilds_at_startup=False)
+    return options
+
+
+class MyClient(discord.AutoShardedClient if sharded else discord.Client):
     global config
 
     def __init__(self, *args, **kwargs):
@@ -457,12 +2113,48 @@ class MyClient(discord.Client):
         print(curtime)
         print('-' * len(str(self.user.id)))
 
+        # Events may have been missed while disconnected, rescan all guilds on their next tick
+        presence_synced.clear()
+        role_members.clear()
+        chunked_guilds.clear()
+        if startup_stats['ready'] is None:
+            startup_stats['ready'] = time.time() - start_time
+            startup_stats['ready_mb'] = get_rss_mb()
+            log("Ready {:.1f}s after starting, using {:.0f} MB".format(
+                startup_stats['ready'], startup_stats['ready_mb']),
+                action='startup')
+
         if ADMIN is None:
             ADMIN = client.get_user(config['admin_id'])
-            await ADMIN.send("READY")
+            if ADMIN is not None:
+                await ADMIN.send("READY")
+
+
+client = MyClient(**get_client_options())
+
+
+@client.event
+async def on_member_update(before, after):
+    if after.guild.id in presence_synced:
+        track_member(after.guild, after, get_member_game(after))
+    update_role_index(after.guild, before, after)
+
+
+@client.event
+async def on_member_remove(member):
+    if member.guild.id in presence_synced:
+        track_member(member.guild, member, None)
+    for members in role_members.get(member.guild.id, {}).values():
+        members.discard(member.id)
 
 
-client = MyClient()
+@client.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name and after.guild.id in sc_index:
+        index = sc_index[after.guild.id]
+        scn = index['channels'].pop(before.name, None)
+        if scn is not None:
+            index['channels'].setdefault(after.name, scn)
 
 
 @client.event
@@ -481,13 +2173,11 @@ async def on_message(message):
         if channel == ADMIN.dm_channel:
             cmd = message.content
             if cmd == 'log':
-                logfile = "log.txt"
+                logfile = sys.stdout.fp if isinstance(sys.stdout, RotatingLogFile) else "log.txt"
                 if not os.path.exists(logfile):
                     await channel.send("No log file")
                     return
-                with open(logfile, 'r', encoding="utf8") as f:
-                    data = f.read()
-                data = data[-10000:]  # Drop everything but the last 10k characters to make string ops quicker
+                data = read_log_tail(logfile, 10000)  # Only the last 10k characters to keep string ops quick
                 data = data.replace('  CMD Y: ', '  C✔ ')
                 data = data.replace('  CMD F: ', '  C✖ ')
                 data = data.replace("Traceback (most recent", "❗❗Traceback (most recent")
@@ -510,23 +2200,61 @@ async def on_message(message):
                 data = data + '```'
                 await channel.send(data)
 
+            if cmd == 'stats':
+                await channel.send(fmsg(format_stats()[:2000 - 8]))
+
+            if cmd == 'cachestats':
+                text = "Settings cache: {} hits, {} disk reads, {} disk writes, {} guilds cached, {} dirty".format(
+                    settings_stats['hits'],
+                    settings_stats['disk_reads'],
+                    settings_stats['disk_writes'],
+                    len(settings_cache),
+                    len(settings_dirty))
+                await channel.send(text)
+
+            if cmd == 'resync':
+                presence_synced.clear()
+                await channel.send("All guilds will be rescanned on their next update.")
+
+            if cmd == 'queue':
+                text = "Action queues: {} queued".format(sum(q.depth() for q in action_queues.values()))
+                for gid, q in action_queues.items():
+                    if q.depth() or q.stats['failed']:
+                        text += "\n{}: {} queued, {}".format(gid, q.depth(), q.stats)
+                await channel.send(text)
+
+            if cmd == 'shards':
+                statuses = settings_store.load_shard_statuses()
+                text = "No shard processes have reported in." if not statuses else ""
+                for key, st in statuses.items():
+                    text += "Shards {}: pid {}, {} guilds, {:.3f}s latency, last seen {:.0f}s ago\n".format(
+                        key, st['pid'], st['guilds'], st['latency'], time.time() - st['updated'])
+                await channel.send(text)
+
             if cmd == 'exit':
                 print("Exiting!")
+                flush_serv_settings()
                 await client.close()
                 sys.exit()
         return
 
+    await handle_guild_message(message)
+
+
+async def handle_guild_message(message):
+    guild = message.guild
+    channel = message.channel
+
     settings = get_serv_settings(guild.id)
 
-    # Cleanup instructions_channel - delete everything older than 24h
-    if channel.id == settings['instructions_channel']:
-        old = datetime.today() - timedelta(days=1)
-        async for m in channel.history(before=old):
-            if m.id != settings['instructions_message']:
-                await m.delete()
+    if getattr(channel, 'category_id', None) == settings['wrapper_category']:
+        record_channel_activity(guild, channel)
 
     # Commands
     if message.content.lower().startswith('gc-'):
+        if guild.id in trace_recorders:
+            trace_recorders[guild.id].record_command(message)
+
         msg = message.content[3:]  # Remove prefix
         split = msg.split(' ')
         cmd = split[0].lower()
@@ -545,6 +2273,7 @@ async def on_message(message):
                     await channel.send("Enabling subcommunities. Turn off with 'gc-disable'.")
                     settings['enabled'] = True
                     set_serv_settings(guild.id, settings)
+                    mark_all_games_changed(guild)
                     await message.add_reaction("✅")
                 return
 
@@ -561,8 +2290,13 @@ async def on_message(message):
                     await message.add_reaction("✅")
                 return
 
+            elif cmd == 'stats':
+                await channel.send(fmsg(format_stats()[:2000 - 8]))
+                await message.add_reaction("✅")
+                return
+
             elif cmd == 'updateinfomessage':
-                await update_info_message(guild)
+                await update_info_message(guild, force=True)
                 await message.add_reaction("✅")
                 return
 
@@ -653,6 +2387,7 @@ async def on_message(message):
                 else:
                     settings['playerthreshold'] = int(thresh)
                     set_serv_settings(guild.id, settings)
+                    mark_all_games_changed(guild)
                     await message.add_reaction("✅")
                     return
 
@@ -689,8 +2424,54 @@ async def on_message(message):
                 await r.edit(content="Pong!", embed=embed)
                 return
 
-            # TODO 'merge' command to join two communities - merge the user list and game names
-            # TODO 'ignore' a game
+            elif cmd == 'merge':
+                names = [strip_quotes(n) for n in params_str.split('>')]
+                if len(names) != 2 or not all(names):
+                    await channel.send("Type the subcommunity to merge, then `>` and the one to merge it into. " +
+                                       "E.g: `gc-merge Rocket League (Steam) > Rocket League`")
+                    await message.add_reaction("❌")
+                    return
+                success = await merge_subcommunities(guild, names[0], names[1], channel)
+                await message.add_reaction("✅" if success else "❌")
+                return
+
+            elif cmd == 'ignore':
+                entry = strip_quotes(params_str)
+                ignored = settings.setdefault('blacklist', [])
+                if not entry:
+                    text = "Ignored games: " + (', '.join("`" + e + "`" for e in ignored) or "none")
+                    if config.get('ignore_games'):
+                        text += "\nIgnored in all servers: " + ', '.join("`" + e + "`" for e in config['ignore_games'])
+                    await channel.send(text)
+                    await message.add_reaction("✅")
+                elif entry.casefold() in (e.casefold() for e in ignored):
+                    await channel.send("`" + entry + "` is already ignored.")
+                    await message.add_reaction("❌")
+                else:
+                    ignored.append(entry)
+                    set_serv_settings(guild.id, settings)
+                    ignore_matchers.pop(guild.id, None)
+                    presence_synced.discard(guild.id)  # Recount the players without it on the next tick
+                    await channel.send("From now on `" + entry + "` won't count as a game. Use * and ? as wildcards, "
+                                       "e.g. `gc-ignore Visual Studio*`. Existing channels are kept, "
+                                       "use `gc-remove` to remove them.")
+                    await message.add_reaction("✅")
+                return
+
+            elif cmd == 'unignore':
+                entry = strip_quotes(params_str)
+                ignored = settings.setdefault('blacklist', [])
+                matches = [e for e in ignored if e.casefold() == entry.casefold()]
+                if not matches:
+                    await channel.send("`" + entry + "` isn't ignored. Use `gc-ignore` to see the ignored games.")
+                    await message.add_reaction("❌")
+                else:
+                    ignored.remove(matches[0])
+                    set_serv_settings(guild.id, settings)
+                    ignore_matchers.pop(guild.id, None)
+                    presence_synced.discard(guild.id)
+                    await message.add_reaction("✅")
+                return
 
         # Commands all users can do
         if cmd == 'join':
@@ -714,5 +2495,61 @@ async def on_message(message):
             await message.add_reaction("❌")
             return
 
-update_loop.start(client)
-client.run(config['token'])
+
+def run_shard_processes():
+    ''' Split the shards into 'shard_processes' groups and run each group as a separate bot process.
+        Crashed processes are restarted, and all of them are stopped once one exits cleanly (e.g. admin 'exit'). '''
+    if not shard_count:
+        print("'shard_count' needs to be set in config.json to run shards in separate processes.")
+        sys.exit(1)
+    groups = [list(range(i, shard_count, config['shard_processes'])) for i in range(config['shard_processes'])]
+
+    def start(ids):
+        env = dict(os.environ, GC_SHARD_IDS=','.join(str(i) for i in ids), GC_SHARD_COUNT=str(shard_count))
+        return subprocess.Popen([sys.executable, os.path.realpath(__file__)], env=env)
+
+    procs = {tuple(ids): start(ids) for ids in groups if ids}
+    while True:
+        time.sleep(5)
+        for ids, p in procs.items():
+            code = p.poll()
+            if code == 0:
+                for other in procs.values():
+                    if other.poll() is None:
+                        other.terminate()
+                return
+            elif code is not None:
+                print("Shard process for shards {} exited with code {}, restarting".format(ids, code))
+                procs[ids] = start(ids)
+
+
+if __name__ == '__main__':
+    if '--import-json' in sys.argv:
+        if not isinstance(settings_store, SqliteSettingsStore):
+            print("Set \"settings_backend\": \"sqlite\" in config.json to import the guild settings into SQLite.")
+            sys.exit(1)
+        print("Imported {} guilds.".format(settings_store.import_json(os.path.join(script_dir, 'guilds'))))
+        sys.exit(0)
+
+    if config.get('shard_processes', 1) > 1 and shard_ids is None:
+        run_shard_processes()
+        sys.exit(0)
+
+    if config.get('snapshot_interval', 300):
+        load_snapshot()
+        atexit.register(save_snapshot)
+        snapshot_loop.start()
+
+    update_loop.change_interval(seconds=get_update_interval())
+    update_loop.start(client)
+    flush_loop.start(client)
+    if config.get('metrics_port') or config.get('metrics_file'):
+        metrics_loop.start()
+    purge_loop.start(client)
+    if config.get('order_channels', False):
+        order_loop.start(client)
+    if config.get('prune_inactive', False):
+        prune_loop.start(client)
+    if config.get('lean_startup', False):
+        chunk_loop.start(client)
+    client.run(config['token'])
@@ -0,0 +1,158 @@
+''' Replay a trace recorded by the bot (see 'trace_guilds' and TraceRecorder in game_channels.py) against a fake guild.
+
+Replays don't touch Discord and are deterministic: the same trace and options always give the same result, and the
+same state digest at the end. Use --set to change guild settings and --config to change the bot's config, to compare
+how they perform on the same traffic, e.g.:
+
+    python3 replay.py traces/1234-20200101-120000.jsonl.gz
+    python3 replay.py traces/1234-20200101-120000.jsonl.gz --set playerthreshold=8 --config welcome_digest=true
+'''
+import sys
+import json
+import gzip
+import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+
+import fake_discord
+from benchmark import setup_environment, drain
+
+
+def read_trace(fp):
+    with gzip.open(fp, 'rt', encoding='utf8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def parse_assignment(s):
+    ''' "key=value" -> (key, value), with the value parsed as JSON if possible. '''
+    k, v = s.split('=', 1)
+    try:
+        return k, json.loads(v)
+    except ValueError:
+        return k, v
+
+
+def build_guild(gc, start, overrides):
+    ''' Recreate the recorded guild: its subcommunity roles and channels, the games list and its members. '''
+    settings = start['settings']
+    settings.update(overrides)
+    guild = fake_discord.Guild(id=start['guild'], name="Replay {}".format(start['guild']))
+    channel_names = {int(k): v for k, v in start['channels'].items()}
+
+    wrapper = guild.add_category("Games", id=settings['wrapper_category'])
+    if settings['instructions_channel']:
+        info = guild.add_text_channel(channel_names.get(settings['instructions_channel'], "games-list"), wrapper,
+                                      id=settings['instructions_channel'])
+        info.add_message("Games list", author=guild.me, id=settings['instructions_message'])
+    for scn, sc in settings['subcommunities'].items():
+        guild.add_role("Plays: " + scn, id=sc['role_id'])
+        if sc['channel_id'] in channel_names:
+            guild.add_text_channel(channel_names[sc['channel_id']], wrapper, id=sc['channel_id'])
+
+    for i, mid in enumerate(start['members']):
+        guild.add_member(mid, "Member {}".format(i))
+    for role_id, holders in start['roles'].items():
+        for mid in holders:
+            m = guild.get_member(mid) or guild.add_member(mid, "Member {}".format(mid))
+            m._roles.add(int(role_id))
+
+    gc.set_serv_settings(guild.id, gc.load_opt_out_sets(settings))
+    return guild
+
+
+def get_member(guild, mid):
+    return guild.get_member(mid) or guild.add_member(mid, "Member {}".format(mid))
+
+
+async def replay(gc, fp, overrides):
+    fake_discord.reset()
+    events = read_trace(fp)
+    start = next(events)
+    start_time = datetime.fromisoformat(start['time'])
+    fake_discord.set_time(start_time)
+    guild = build_guild(gc, start, overrides)
+    initial_scs = set(gc.get_serv_settings(guild.id)['subcommunities'])
+
+    tick_times = []
+    commands = 0
+    for event in events:
+        fake_discord.set_time(start_time + timedelta(seconds=event['t']))
+        if event['e'] == 'tick':
+            for mid, game in sorted(event['set'].items()):
+                m = get_member(guild, int(mid))
+                before = m.copy()
+                m.activity = fake_discord.Activity(game)
+                await gc.on_member_update(before, m)
+            for mid in event['clr']:
+                m = get_member(guild, int(mid))
+                before = m.copy()
+                m.activity = None
+                await gc.on_member_update(before, m)
+            t = time.perf_counter()
+            await gc.update_subcommunities(guild)
+            tick_times.append(time.perf_counter() - t)
+        elif event['e'] == 'cmd':
+            channel = guild.get_channel(event['channel'])
+            if channel is None:
+                channel = guild.add_text_channel("channel-{}".format(event['channel']), id=event['channel'])
+            message = channel.add_message(event['content'], author=get_member(guild, event['author']))
+            await gc.handle_guild_message(message)
+            commands += 1
+        await drain(gc)
+
+    settings = gc.get_serv_settings(guild.id)
+    state = {scn: sorted(m.id for m in guild.get_role(sc['role_id']).members) if guild.get_role(sc['role_id']) else []
+             for scn, sc in sorted(settings['subcommunities'].items())}
+    return {
+        "ticks": len(tick_times),
+        "commands": commands,
+        "tick_ms": sorted(t * 1000 for t in tick_times),
+        "api_calls": dict(fake_discord.api_calls),
+        "created": sorted(set(settings['subcommunities']) - initial_scs),
+        "removed": sorted(initial_scs - set(settings['subcommunities'])),
+        "digest": hashlib.sha256(json.dumps([state, sorted(fake_discord.api_calls.items())]).encode()).hexdigest(),
+    }
+
+
+def report(r):
+    ticks = r['tick_ms'] or [0.0]
+    print("Replayed {} ticks and {} commands".format(r['ticks'], r['commands']))
+    print("  tick ms: p50 {:.1f}, p99 {:.1f}, max {:.1f}, total {:.1f}".format(
+        ticks[len(ticks) // 2], ticks[min(len(ticks) - 1, int(len(ticks) * 0.99))], ticks[-1], sum(ticks)))
+    print("  API calls: {} ({})".format(sum(r['api_calls'].values()),
+                                        ', '.join("{} {}".format(k, v) for k, v in sorted(r['api_calls'].items()))))
+    print("  subcommunities created: {}, removed: {}".format(len(r['created']), len(r['removed'])))
+    print("  state digest: " + r['digest'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', help="trace file recorded by the bot")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a guild setting, e.g. playerthreshold=8")
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a config.json option, e.g. welcome_digest=true")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="show the bot's log messages")
+    args = parser.parse_args()
+
+    config = {"info_message_delay": 0}  # Debounce timers depend on wall clock time, refresh right away instead
+    config.update(parse_assignment(s) for s in args.config)
+    data_dir, gc = setup_environment(config, args.verbose)
+    try:
+        r = asyncio.run(replay(gc, args.trace, dict(parse_assignment(s) for s in args.set)))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    report(r)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(r, f, indent=4)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()